@@ -1,10 +1,27 @@
 from errors import InvalidUsage
 from flask import Flask, jsonify
+from request_logging import RequestLogger
+from eventbot.integrations.dedup import DedupStore
+import eventbot.settings
+import logging
+import os
 
 app = Flask(__name__)
 
 app.config.setdefault('WTF_CSRF_ENABLED', False)
 
+RequestLogger(
+    level=logging.getLevelName(eventbot.settings.REQUEST_LOG_LEVEL),
+    sample_rate=eventbot.settings.REQUEST_LOG_SAMPLE_RATE,
+    max_body_length=eventbot.settings.REQUEST_LOG_BODY_MAX_LENGTH
+).init_app(app)
+
+# Responses to webhook deliveries, for answering redeliveries (see routes.deduplicated).
+app.extensions['dedup'] = DedupStore(
+    os.path.join(eventbot.settings.WEBHOOK_DEDUP_DIR, 'webhooks.sqlite')
+    if eventbot.settings.WEBHOOK_DEDUP_DIR else ':memory:'
+)
+
 import routes
 
 
@@ -2,8 +2,16 @@
 # Attendee reporter #
 #####################
 
+import logging
+import simplejson as json
+
 import eventbot.settings
+import eventbrite.api_client as eventbrite_client
 import mailchimp.api_client as mailchimp_client
+from mailchimp.api_client import NotFoundException
+from slack import api_client as slack
+
+log = logging.getLogger(__name__)
 
 
 def check_interests(email, interests):
@@ -1,19 +1,43 @@
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 import dateutil.parser
 import eventbrite
+import collections
+import hashlib
+import itertools
 import logging
 import requests
-import requests_cache
 import simplejson
+import urllib
 
 import eventbot.integrations.defaults
+from eventbot.app.eventbrite.attendee import Attendee
+from eventbot.integrations import cache, transport
 
 log = logging.getLogger(__name__)
 
+ATTENDEE_STATUS_ATTENDING = 'attending'
+ATTENDEE_STATUS_NOT_ATTENDING = 'not_attending'
+ATTENDEE_STATUS_UNPAID = 'unpaid'
+ATTENDEE_STATUSES = (ATTENDEE_STATUS_ATTENDING, ATTENDEE_STATUS_NOT_ATTENDING, ATTENDEE_STATUS_UNPAID)
+
+EVENT_STATUS_LIVE = 'live'
+EVENT_STATUS_ALL = 'all'
+EVENT_ORDER_START_ASC = 'start_asc'
+EVENT_ORDER_START_DESC = 'start_desc'
+EVENT_ORDERINGS = (EVENT_ORDER_START_ASC, EVENT_ORDER_START_DESC, 'created_asc', 'created_desc')
+
+
+class EventbriteException(Exception):
+    pass
+
 
 class EventbriteClient:
 
     eventbrite_sdk_client = None
+    cache_timeout = eventbot.integrations.defaults.REQUESTS_CACHE_TIMEOUT
+    """:type : cache.ResponseCache"""
+    cache = None
 
     def __init__(
             self,
@@ -22,17 +46,266 @@ class EventbriteClient:
             use_cache=False
     ):
         self.eventbrite_sdk_client = eventbrite.Eventbrite(eventbrite_oauth_token)
+        self.cache_timeout = cache_timeout
         if use_cache:
-            requests_cache.install_cache('eventbot', expire_after=cache_timeout)
+            self.cache = cache.get_cache('eventbrite')
 
     def get_event_snippets(self, statuses=['live']):
         """ Generate a set of 'snippets' for all the user's events for a
             set of status values (defaults to 'live' events).
+
+            Snippets are cached for EVENTBRITE_SNIPPETS_CACHE_TIMEOUT seconds when the cache is enabled.
+        """
+        if self.cache is None:
+            return self._build_event_snippets(statuses)
+        key = '{}:snippets:{}'.format(self._account_key(), ','.join(sorted(statuses)))
+        text = self.cache.get_or_fetch(
+            key,
+            lambda: simplejson.dumps(self._build_event_snippets(statuses)),
+            ttl=eventbot.integrations.defaults.EVENTBRITE_SNIPPETS_CACHE_TIMEOUT
+        )
+        return simplejson.loads(text)
+
+    def get_user_owned_events(self, expand=None, status=None, order_by=None):
+        """
+        Get events owned by current user.
+        :param expand: list of expansions to include with each event, e.g. ['ticket_classes']
+        :param status: event status to filter by, as for iter_user_owned_events
+        :param order_by: ordering, as for iter_user_owned_events
+        :return: dict with the list of events under 'events'
+        """
+        events = list(self.iter_user_owned_events(expand=expand, status=status, order_by=order_by))
+        return {'events': events}
+
+    def iter_user_owned_events(self, expand=None, status=None, order_by=None):
+        """
+        Yield events owned by current user, fetching each page only when the previous one is used up.
+        :param expand: list of expansions to include with each event, e.g. ['ticket_classes']
+        :param status: event status to filter by (e.g. 'live', 'ended' or 'all'), or None for Eventbrite's default
+        :param order_by: one of EVENT_ORDERINGS, or None for Eventbrite's default
+        :return: generator of event dicts
+        """
+        if order_by is not None and order_by not in EVENT_ORDERINGS:
+            raise ValueError("Unknown event ordering: {}".format(order_by))
+        params = {}
+        if expand:
+            params['expand'] = ','.join(expand)
+        if status is not None:
+            params['status'] = status
+        if order_by is not None:
+            params['order_by'] = order_by
+        page_number = 1
+        while True:
+            data = self._get('users/me/owned_events/', params=dict(params, page=page_number))
+            assert 'page_count' in data.get('pagination', {}), simplejson.dumps(data)
+            for event in data['events']:
+                yield event
+            if page_number >= data['pagination']['page_count']:
+                break
+            page_number += 1
+
+    def get_next_event(self, current_datetime=None):
+        """
+        Get the live event that starts next, or None if there isn't one.
+
+        Events are requested in start order, so this usually needs only the first page.
+        :param current_datetime: ISO 8601 string to use as the current time, for testing
+        :return: event dict or None
+        """
+        events = self.iter_user_owned_events(status=EVENT_STATUS_LIVE, order_by=EVENT_ORDER_START_ASC)
+        for event in events:
+            if calculate_days_remaining(event, current_datetime=current_datetime, field='end') >= 0:
+                return event
+        return None
+
+    def get_event_ticket_classes(self, event_id):
+        return self._get('events/{}/ticket_classes/'.format(event_id))
+
+    def get_ticket_classes_by_event(
+            self,
+            event_ids,
+            concurrency=eventbot.integrations.defaults.EVENTBRITE_BATCH_CONCURRENCY
+    ):
+        """
+        Fetch the ticket classes of several events through the batch endpoint.
+
+        Events whose batched request fails are fetched individually, `concurrency` at a time.
+        :param event_ids: list of event IDs
+        :return: dict of event ID -> list of ticket classes
+        """
+        event_ids = list(event_ids)
+        if not event_ids:
+            return {}
+        batch_size = eventbot.integrations.defaults.EVENTBRITE_BATCH_SIZE
+        responses = []
+        for i in range(0, len(event_ids), batch_size):
+            chunk = event_ids[i:i + batch_size]
+            batch_urls = [
+                {'method': 'GET', 'relative_url': '/events/{}/ticket_classes/'.format(event_id)} for event_id in chunk
+            ]
+            try:
+                responses += self.get_batch(batch_urls)
+            except (EventbriteException, requests.exceptions.RequestException) as e:
+                log.warn("Ticket class batch failed, fetching {} event(s) one by one ({})".format(len(chunk), e))
+                responses += [None] * len(chunk)
+        ticket_classes = {
+            event_id: data['ticket_classes']
+            for event_id, data in zip(event_ids, responses) if data is not None and 'error' not in data
+        }
+        missing = [event_id for event_id in event_ids if event_id not in ticket_classes]
+        if missing:
+            pool = ThreadPool(min(concurrency, len(missing)))
+            try:
+                for event_id, data in zip(missing, pool.map(self.get_event_ticket_classes, missing)):
+                    ticket_classes[event_id] = data['ticket_classes']
+            finally:
+                pool.terminate()
+        return ticket_classes
+
+    def get_event_attendees(self, event_id, status=None, compact=False):
+        """
+        Returns a list of event attendees.
+        :param event_id: the ID of the event
+        :param status: optional attendee status filter, as for iter_event_attendees
+        :param compact: whether to return Attendee records rather than attendee dicts
+        :return:
+        """
+        attendees = list(self.iter_event_attendees(event_id, status=status, compact=compact))
+        debug("Number of attendees", len(attendees))
+        return attendees
+
+    def iter_event_attendees(self, event_id, status=None, changed_since=None, compact=False):
         """
+        Yield event attendees one page at a time, without holding the whole list in memory.
+        :param event_id: the ID of the event
+        :param status: one of ATTENDEE_STATUSES to have Eventbrite filter attendees, or None for all
+        :param changed_since: UTC time as 'YYYY-MM-DDThh:mm:ssZ' to get only attendees changed since then
+        :param compact: whether to yield Attendee records rather than attendee dicts
+        :return: generator of attendee dicts or Attendee records
+        """
+        if status is not None and status not in ATTENDEE_STATUSES:
+            raise ValueError("Unknown attendee status: {}".format(status))
+        path = 'events/{}/attendees/'.format(event_id)
+        params = {}
+        if status is not None:
+            params['status'] = status
+        if changed_since is not None:
+            params['changed_since'] = changed_since
+        first_page = self._get(path, params=params or None)
+        pagination = first_page.get('pagination', {})
+        assert 'page_count' in pagination or 'continuation' in pagination, simplejson.dumps(first_page)
+        log.debug(pagination)
+        count = 0
+        if 'page_count' in pagination:
+            pages = itertools.chain(
+                [first_page],
+                self.iter_pages(path, range(2, pagination['page_count'] + 1), params=params)
+            )
+        else:
+            # Without page numbers, the pages can only be walked in turn.
+            pages = self._iter_continuation_pages(path, params, first_page)
+        for page_number, page in enumerate(pages, 1):
+            log.debug("Processing page {0} of {1}".format(page_number, pagination.get('page_count', '?')))
+            for attendee in page['attendees']:
+                count += 1
+                yield Attendee.from_eventbrite(attendee) if compact else attendee
+        if 'object_count' in pagination:
+            assert count == pagination['object_count'],\
+                "len(attendees)={0}, object_count={1}".format(count, pagination['object_count'])
+
+    def _iter_continuation_pages(self, path, params, page):
+        """ Yield a page and the pages after it, following Eventbrite's continuation token.
+        """
+        yield page
+        while page['pagination'].get('has_more_items') and page['pagination'].get('continuation'):
+            params = dict(params, continuation=page['pagination']['continuation'])
+            page = self._get(path, params=params)
+            yield page
+
+    def iter_pages(
+            self,
+            path,
+            page_numbers,
+            params=None,
+            batch_size=eventbot.integrations.defaults.EVENTBRITE_BATCH_SIZE,
+            concurrency=eventbot.integrations.defaults.EVENTBRITE_BATCH_CONCURRENCY
+    ):
+        """
+        Fetch pages of a paginated API path through the batch endpoint, yielding them in order.
+
+        The pages are split into batches of at most `batch_size` requests, and up to `concurrency`
+        batches are in flight at once; a batch is only submitted when an earlier one is handed to the
+        caller, so memory is bounded however many pages there are. A page that fails within a batch
+        is fetched again on its own.
+        :param path: API path, relative to the API root
+        :param page_numbers: list of page numbers
+        :param params: dict of query parameters to send with every page
+        :param batch_size: maximum number of requests per batch
+        :param concurrency: maximum number of batches in flight
+        :return: generator of page dicts
+        """
+        chunks = [page_numbers[i:i + batch_size] for i in range(0, len(page_numbers), batch_size)]
+        if not chunks:
+            return
+        pool = ThreadPool(min(concurrency, len(chunks)))
+        pending = collections.deque()
+        chunks = iter(chunks)
+        try:
+            for chunk in itertools.islice(chunks, concurrency):
+                pending.append(pool.apply_async(self._get_pages, (path, chunk, params or {})))
+            while pending:
+                pages = pending.popleft().get()
+                for chunk in itertools.islice(chunks, 1):
+                    pending.append(pool.apply_async(self._get_pages, (path, chunk, params or {})))
+                for page in pages:
+                    yield page
+        finally:
+            pool.terminate()
+
+    def _get_pages(self, path, page_numbers, params):
+        batch_urls = [
+            {
+                'method': 'GET',
+                'relative_url': '/{}?{}'.format(path, urllib.urlencode(sorted(dict(params, page=n).items())))
+            } for n in page_numbers
+        ]
+        try:
+            responses = self.get_batch(batch_urls)
+        except (EventbriteException, requests.exceptions.RequestException) as e:
+            log.warn("Batch of {} page(s) of {} failed, fetching them one by one ({})".format(
+                len(page_numbers),
+                path,
+                e
+            ))
+            responses = [None] * len(page_numbers)
+        pages = []
+        for page_number, page in zip(page_numbers, responses):
+            if page is None or 'error' in page:
+                page = self._get_page(path, page_number, params)
+            pages.append(page)
+        return pages
+
+    def _get_page(self, path, page_number, params):
+        """ Fetch a single page, retrying it a few times before giving up.
+        """
+        retries = eventbot.integrations.defaults.EVENTBRITE_PAGE_RETRIES
+        for attempt in range(retries + 1):
+            try:
+                return self._get(path, params=dict(params, page=page_number))
+            except (EventbriteException, requests.exceptions.RequestException) as e:
+                if attempt == retries:
+                    raise
+                log.warn("Page {} of {} failed, retrying ({})".format(page_number, path, e))
+
+    def _build_event_snippets(self, statuses):
+        # Eventbrite filters by a single status; anything else is filtered here.
+        status = statuses[0] if len(statuses) == 1 else EVENT_STATUS_ALL
+        user_events = self.iter_user_owned_events(expand=['ticket_classes'], status=status)
+        events = [e for e in user_events if e['status'] in statuses]
+        # Ticket classes normally come with the expansion; fetch them for any event that lacks them.
+        ticket_classes = self.get_ticket_classes_by_event([e['id'] for e in events if 'ticket_classes' not in e])
         snippets = []
-        user_events = self.get_user_owned_events()
-        for e in [e for e in user_events['events'] if e['status'] in statuses]:
-            ticket_classes = self.eventbrite_sdk_client.get_event_ticket_classes(event_id=e['id'])
+        for e in events:
             snippets.append(
                 {
                     'name': e['name']['text'],
@@ -40,79 +313,53 @@ class EventbriteClient:
                     'status': e['status'],
                     'start': e['start'],
                     'days_remaining': calculate_days_remaining(e),
-                    'quantity_sold': calculate_quantity_sold(ticket_classes['ticket_classes']),
+                    'quantity_sold': calculate_quantity_sold(e.get('ticket_classes', ticket_classes.get(e['id']))),
                     'capacity': e['capacity']
                 }
             )
         return snippets
 
-    def get_user_owned_events(self):
-        """
-        Get events owned by current user.
-        :return:
-        """
-        data = self.eventbrite_sdk_client.get_user_owned_events(id='me')
-        if 'error' in data:
-            raise Exception(simplejson.dumps(data))
-        assert 'page_count' in data.get('pagination', {}), simplejson.dumps(data)
-        if data['pagination']['page_count'] > 1:
-            raise Exception("There are {0} pages of data".format(data['page_count']))
-        return data
+    def _account_key(self):
+        # The cache is shared between clients, so keep accounts apart.
+        return hashlib.md5(self.eventbrite_sdk_client.oauth_token or '').hexdigest()
 
-    def get_event_attendees(self, event_id):
-        """
-        Returns a list of event attendees.
-        :param event_id: the ID of the event
-        :return:
+    def _get(self, path, params=None):
+        """ Get an API path (relative to the API root), through the cache if it is enabled.
         """
-        first_page_data = self.eventbrite_sdk_client.get_event_attendees(event_id=event_id)
-        if 'error' in first_page_data:
-            raise Exception(simplejson.dumps(first_page_data))
-        assert 'page_count' in first_page_data.get('pagination', {}), simplejson.dumps(first_page_data)
-        page_count = first_page_data['pagination']['page_count']
-        object_count = first_page_data['pagination']['object_count']
-        log.debug(first_page_data['pagination'])
-        if page_count > 1:
-            batch_urls = []
-            for i in range(page_count):
-                batch_urls.append({
-                    "method": "GET",
-                    "relative_url": "/events/{0}/attendees/?page={1}".format(event_id, i+1)
-                })
-            data = self.get_batch(batch_urls)
-            attendees = []
-            i = 1
-            for page in data:
-                log.debug("Processing page {0}".format(i))
-                attendees += page['attendees']
-                i += 1
-        else:
-            attendees = first_page_data['attendees']
-        log.debug("first_page_data['pagination']: {}".format(simplejson.dumps(first_page_data['pagination'])))
-        assert len(attendees) == object_count,\
-            "len(attendees)={0}, object_count={1}".format(len(attendees), object_count)
-        debug("Number of attendees", len(attendees))
-        return attendees
+        url = '{}{}'.format(eventbrite.utils.EVENTBRITE_API_URL, path)
+        if self.cache is None:
+            return self.get_url(url, params=params)
+        key = '{}:{}'.format(self._account_key(), cache.build_key(url, params))
+
+        def fetch_text():
+            return simplejson.dumps(self.get_url(url, params=params))
 
-    def get_url(self, url):
-        resp = requests.get(url, headers=self.eventbrite_sdk_client.headers)
+        return simplejson.loads(self.cache.get_or_fetch(key, fetch_text, ttl=self.cache_timeout))
+
+    def get_url(self, url, params=None):
+        resp = transport.get(url, headers=self.eventbrite_sdk_client.headers, params=params)
         data = resp.json()
         log.debug("data: {}".format(data))
+        if 'error' in data:
+            raise EventbriteException(simplejson.dumps(data))
         return data
 
     def get_batch(self, batch_urls):
+        """
+        Send a list of requests through the batch endpoint.
+        :param batch_urls: list of {'method', 'relative_url'} dicts
+        :return: list of response bodies, in request order; None for any request that failed
+        """
         endpoint_url = "{0}batch/".format(eventbrite.utils.EVENTBRITE_API_URL)
         log.debug("Batch URLs: {0}".format(simplejson.dumps(batch_urls)))
         post_data = {"batch": simplejson.dumps(batch_urls)}
-        response = requests.post(
+        response = transport.post(
             endpoint_url,
             data=simplejson.dumps(post_data),
             headers=self.eventbrite_sdk_client.headers
         )
         if response.status_code != 200:
-            raise Exception(response.content)
-        if 'error' in response:
-            raise Exception(simplejson.dumps(response.content))
+            raise EventbriteException(response.content)
         response_data = response.json()
         debug("Number of responses received", len(response_data))
         # debug("response_data", response_data)
@@ -120,7 +367,11 @@ class EventbriteClient:
         # responses = [simplejson.loads(item['body']) for item in response_data]
         responses = []
         for item in response_data:
-            responses.append(simplejson.loads(item['body']))
+            if item.get('code', 200) != 200:
+                log.debug("Batch request failed: {}".format(simplejson.dumps(item)))
+                responses.append(None)
+            else:
+                responses.append(simplejson.loads(item['body']))
         debug("Number of responses processed", len(responses))
         assert_len(responses, response_data, "responses/response_data")
         return responses
@@ -134,8 +385,8 @@ def assert_len(x, y, text):
     assert len(x) == len(y), "{0}: len(x)={1}, len(y)={2}".format(text, len(x), len(y))
 
 
-def calculate_days_remaining(event, current_datetime=None):
-    start_date = event['start']['utc']
+def calculate_days_remaining(event, current_datetime=None, field='start'):
+    start_date = event[field]['utc']
     d0 = dateutil.parser.parse(start_date, ignoretz=True)
     if current_datetime is not None:
         d1 = dateutil.parser.parse(current_datetime, ignoretz=True)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+
+class Attendee(object):
+
+    """ Compact record of an Eventbrite attendee, holding only the fields we use.
+
+    Eventbrite's attendee documents carry addresses, barcodes, costs, questions and more;
+    building these records while parsing pages keeps large attendee lists small.
+    """
+
+    __slots__ = (
+        'id',
+        'event_id',
+        'email',
+        'first_name',
+        'last_name',
+        'name',
+        'ticket_class_name',
+        'refunded',
+        'cancelled',
+        'status',
+        'changed',
+    )
+
+    def __init__(
+            self,
+            id,
+            event_id=None,
+            email='',
+            first_name='',
+            last_name='',
+            name='',
+            ticket_class_name='',
+            refunded=False,
+            cancelled=False,
+            status=None,
+            changed=None
+    ):
+        self.id = id
+        self.event_id = event_id
+        self.email = email
+        self.first_name = first_name
+        self.last_name = last_name
+        self.name = name
+        self.ticket_class_name = ticket_class_name
+        self.refunded = refunded
+        self.cancelled = cancelled
+        self.status = status
+        self.changed = changed
+
+    @classmethod
+    def from_eventbrite(cls, data):
+        """ Build a record from an attendee document returned by the Eventbrite API.
+        """
+        profile = data.get('profile', {})
+        return cls(
+            data.get('id'),
+            event_id=data.get('event_id'),
+            email=profile.get('email', ''),
+            first_name=profile.get('first_name', ''),
+            last_name=profile.get('last_name', ''),
+            name=profile.get('name', ''),
+            ticket_class_name=data.get('ticket_class_name', ''),
+            refunded=data.get('refunded', False),
+            cancelled=data.get('cancelled', False),
+            status=data.get('status'),
+            changed=data.get('changed')
+        )
+
+    @classmethod
+    def from_tuple(cls, values):
+        return cls(*values)
+
+    def to_tuple(self):
+        """ Return the fields as a tuple, in __slots__ order, e.g. for storage.
+        """
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def is_attending(self):
+        return not self.refunded and not self.cancelled
+
+    def __eq__(self, other):
+        return isinstance(other, Attendee) and self.to_tuple() == other.to_tuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Attendee(id={!r}, email={!r}, ticket_class_name={!r})'.format(
+            self.id,
+            self.email,
+            self.ticket_class_name
+        )
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+import datetime
+import logging
+import sqlite3
+import threading
+
+import simplejson
+
+import eventbot.settings
+from eventbot.app.eventbrite.attendee import Attendee
+
+log = logging.getLogger(__name__)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class EventbriteAttendeeStore:
+
+    """ Persistent per-event copy of Eventbrite attendee lists.
+
+    Attendees are kept as compact Attendee records. The first sync of an event downloads every
+    attendee; later syncs ask Eventbrite only for attendees changed since the previous sync and
+    merge them in. Attendees of every status are kept, because a delta filtered by status would
+    miss attendees who have just been refunded or cancelled; filter them when reading instead.
+    """
+
+    path = ''
+
+    def __init__(self, path=':memory:'):
+        """
+
+        :param path: path of the SQLite file, or ':memory:' for a store that lasts as long as the process
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._sync_locks = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS attendee_records '
+            '(event_id TEXT, attendee_id TEXT, data TEXT, PRIMARY KEY (event_id, attendee_id))'
+        )
+        self._db.execute('CREATE TABLE IF NOT EXISTS syncs (event_id TEXT PRIMARY KEY, last_synced TEXT)')
+        self._db.commit()
+
+    def sync(self, eb, event_id, full=False):
+        """
+        Bring the stored attendees of an event up to date, returning the number of attendees fetched.
+        :param eb: EventbriteClient
+        :param event_id: the ID of the event
+        :param full: whether to download every attendee again, dropping the stored ones
+        """
+        # Syncs of the same event take turns; the download itself holds no lock that readers or
+        # syncs of other events need.
+        with self._sync_lock(event_id):
+            started = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            last_synced = None if full else self.last_synced(event_id)
+            attendees = list(eb.iter_event_attendees(event_id, changed_since=last_synced, compact=True))
+            with self._lock:
+                try:
+                    if last_synced is None:
+                        self._db.execute('DELETE FROM attendee_records WHERE event_id = ?', (event_id,))
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO attendee_records VALUES (?, ?, ?)',
+                        [(event_id, a.id, simplejson.dumps(a.to_tuple())) for a in attendees]
+                    )
+                    self._db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?)', (event_id, started))
+                    self._db.commit()
+                except Exception:
+                    self._db.rollback()
+                    raise
+        count = len(attendees)
+        log.debug('Attendees of event_id={} synced: {} attendee(s) fetched ({})'.format(
+            event_id,
+            count,
+            'full' if last_synced is None else 'changed since {}'.format(last_synced)
+        ))
+        return count
+
+    def last_synced(self, event_id):
+        """ Get the time of the last sync of an event, or None if it has never been synced.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT last_synced FROM syncs WHERE event_id = ?', (event_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def iter_attendees(self, event_id):
+        """ Yield the stored attendees of an event, as Attendee records.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT data FROM attendee_records WHERE event_id = ? ORDER BY attendee_id',
+                (event_id,)
+            ).fetchall()
+        for row in rows:
+            yield Attendee.from_tuple(simplejson.loads(row[0]))
+
+    def count(self, event_id):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM attendee_records WHERE event_id = ?',
+                (event_id,)
+            ).fetchone()[0]
+
+    def _sync_lock(self, event_id):
+        with self._lock:
+            return self._sync_locks.setdefault(event_id, threading.Lock())
+
+    def invalidate(self, event_id=None):
+        """ Drop the stored attendees of one event, or of every event when no ID is given.
+        """
+        with self._lock:
+            if event_id is None:
+                self._db.execute('DELETE FROM attendee_records')
+                self._db.execute('DELETE FROM syncs')
+            else:
+                self._db.execute('DELETE FROM attendee_records WHERE event_id = ?', (event_id,))
+                self._db.execute('DELETE FROM syncs WHERE event_id = ?', (event_id,))
+            self._db.commit()
+
+
+def get_store(path=None):
+    """ Return the process-wide store for the path, creating it if necessary.
+
+    :param path: path of the SQLite file; defaults to settings.ATTENDEE_STORE_PATH, or memory if that is unset
+    """
+    path = path or eventbot.settings.ATTENDEE_STORE_PATH or ':memory:'
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = EventbriteAttendeeStore(path)
+            _stores[path] = store
+    return store
+
+
+def invalidate_all():
+    """ Invalidate every store in the process.
+    """
+    with _stores_lock:
+        for store in _stores.values():
+            store.invalidate()
@@ -1 +1,3 @@
 import api_client
+import mirror
+import concurrent_client
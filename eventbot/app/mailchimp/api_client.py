@@ -1,17 +1,47 @@
 #!/usr/bin/env python
 import hashlib
+import io
+import json
 import logging
-import requests
-import requests_cache
+import tarfile
+import threading
+import time
 
 import eventbot.integrations.defaults
+from eventbot.app.mailchimp import registry
+from eventbot.integrations import cache, transport
 
 # http://developer.mailchimp.com/documentation/mailchimp/guides/get-started-with-mailchimp-api-3/
 REGION = "us2"
 BASE_URL = 'https://{}.api.mailchimp.com/3.0'.format(REGION)
 
+# Cache TTLs (seconds) by path: list metadata rarely changes, member data often does.
+CACHE_TTLS = [
+    (r'/search-members', 60),
+    (r'/members', 60),
+    (r'/lists', 3600),
+]
+
+MEMBERS_PAGE_SIZE = 500
+
+# Minimal projections for the fields our callers actually read.
+MEMBER_FIELDS = ['id', 'email_address', 'interests']
+MIRROR_MEMBER_FIELDS = MEMBER_FIELDS + ['status', 'last_changed']
+SEARCH_FIELDS = ['exact_matches.members.{}'.format(f) for f in MEMBER_FIELDS]
+
+BATCH_POLL_INTERVAL = 5
+BATCH_TIMEOUT = 600
+
+# How MailChimpInterestManager checks that an interest change was applied.
+VERIFY_NONE = 'none'
+VERIFY_RESPONSE = 'response'
+VERIFY_REFETCH = 'refetch'
+
 log = logging.getLogger(__name__)
 
+# Subscriber hashes recently searched for and not found, shared by every client in the process.
+_not_found = cache.ExpiringSet(ttl=eventbot.integrations.defaults.NOT_FOUND_CACHE_TIMEOUT)
+
 
 class TooManyFoundException(Exception):
     pass
@@ -21,67 +51,106 @@ class NotFoundException(Exception):
     pass
 
 
+class BatchTimeoutException(Exception):
+    pass
+
+
+class InterestVerificationException(Exception):
+    pass
+
+
 class MailChimpClient:
 
     api_key = ''
     list_name = ''
     use_cache = True
+    cache_timeout = eventbot.integrations.defaults.REQUESTS_CACHE_TIMEOUT
+    metadata_timeout = eventbot.integrations.defaults.METADATA_REGISTRY_TIMEOUT
+    """:type : registry.MailChimpMetadataRegistry"""
+    registry = None
+    mirrors = None
+    """:type : cache.ResponseCache"""
+    cache = None
+    session = None
 
     def __init__(
             self,
             api_key,
             cache_timeout=eventbot.integrations.defaults.REQUESTS_CACHE_TIMEOUT,
-            use_cache=True
+            use_cache=True,
+            metadata_timeout=eventbot.integrations.defaults.METADATA_REGISTRY_TIMEOUT,
+            session=None
     ):
+        """
+
+        :param api_key: basestring
+        :param cache_timeout: number of seconds responses are cached for by default
+        :param use_cache: boolean
+        :param metadata_timeout: number of seconds list and interest metadata is kept in the registry
+        :param session: requests.Session to send requests with, or None to use the shared transport
+        """
         self.api_key = api_key
+        self.session = session if session is not None else transport.get_session(BASE_URL)
         self.use_cache = use_cache
+        self.cache_timeout = cache_timeout
+        self.metadata_timeout = metadata_timeout
+        self.registry = registry.get_registry(api_key)
+        self.mirrors = {}
         if self.use_cache is True:
-            requests_cache.install_cache('mailchimp', expire_after=cache_timeout)
+            self.cache = cache.get_cache('mailchimp', ttls=CACHE_TTLS)
+
+    def attach_mirror(self, mirror):
+        """ Answer member lookups for the mirror's list from the mirror instead of searching.
+
+        :param mirror: mirror.MailChimpMemberMirror
+        """
+        self.mirrors[mirror.list_id] = mirror
 
     def check_interest(self, email, list_name, interest_category_name, interest_name):
         """ Check whether the specified email address is in the list and has the interest.
         """
-        search_result = self.search(email)
-        members = search_result['exact_matches']['members']
-        if len(members) > 1:
-            raise TooManyFoundException("Number of exact matches should never be greater than 1!")
-        if len(members) < 1:
-            # alt_search_result = self.search(email, alldata=True)
-            raise NotFoundException("email {} not found in the database".format(email))
+        not_found_key = self._not_found_key(calculate_subscriber_hash(normalize_email(email)))
+        if self.use_cache and not_found_key in _not_found:
+            raise NotFoundException("email {} not found in the database (cached)".format(email))
+        mirror = self.mirrors.get(self.lookup_list_id(list_name)) if self.mirrors else None
+        if mirror is not None:
+            member = mirror.get(email)
+            if member is None:
+                raise NotFoundException("email {} not found in the database".format(email))
+        else:
+            search_result = self.search(email, fields=SEARCH_FIELDS)
+            members = search_result['exact_matches']['members']
+            if len(members) > 1:
+                raise TooManyFoundException("Number of exact matches should never be greater than 1!")
+            if len(members) < 1:
+                # alt_search_result = self.search(email, alldata=True)
+                if self.use_cache:
+                    _not_found.add(not_found_key)
+                raise NotFoundException("email {} not found in the database".format(email))
+            member = members[0]
         interest_id = self.lookup_interest_id(list_name, interest_category_name, interest_name)
-        return members[0]['interests'].get(interest_id, False)
+        return member['interests'].get(interest_id, False)
 
-    def search(self, email, alldata=False):
+    def search(self, email, alldata=False, fields=None, exclude_fields=None):
         """ Search for a member by email.
         """
-        if alldata:
-            path = '/search-members?query=alldata:{}'.format(email)
-        else:
-            path = '/search-members?query={}'.format(email)
-        o = self._get(path=path)
+        path = '/search-members'
+        params = {'query': 'alldata:{}'.format(email) if alldata else email}
+        o = self._get(path=path, params=with_projection(params, fields, exclude_fields))
         return o
 
     def lookup_interest_id(self, list_name, interest_category_name, interest_name):
-        list_id = self.lookup_list_id(list_name)
-        interest_category_id = self.lookup_interest_category_id(list_name, interest_category_name)
-        o = self.get_interests(list_id, interest_category_id)
-        name_id_map = {l['name']: l['id'] for l in o['interests']}
-        return name_id_map.get(interest_name, False)
+        return self.registry.lookup_interest_id(self, list_name, interest_category_name, interest_name)
 
     def lookup_interest_category_id(self, list_name, interest_category_name):
-        list_id = self.lookup_list_id(list_name)
-        o = self.get_interest_categories(list_id)
-        name_id_map = {l['title']: l['id'] for l in o['categories']}
-        return name_id_map.get(interest_category_name, False)
+        return self.registry.lookup_interest_category_id(self, list_name, interest_category_name)
 
     def lookup_list_id(self, name):
-        lists = self.get_lists()
-        name_id_map = {l['name']: l['id'] for l in lists['lists']}
-        return name_id_map.get(name, False)
+        return self.registry.lookup_list_id(self, name)
 
-    def get_interests(self, list_id, interest_category_id):
+    def get_interests(self, list_id, interest_category_id, fields=None, exclude_fields=None):
         path = '/lists/{}/interest-categories/{}/interests'.format(list_id, interest_category_id)
-        interests = self._get(path)
+        interests = self._get(path, params=with_projection(None, fields, exclude_fields))
         log.debug('{} interest/s returned for list_id={} interest_category_id={}'.format(
             len(interests['interests']),
             list_id,
@@ -89,54 +158,203 @@ class MailChimpClient:
         )
         return interests
 
-    def get_interest_categories(self, list_id):
+    def get_interest_categories(self, list_id, fields=None, exclude_fields=None):
         path = '/lists/{}/interest-categories'.format(list_id)
-        interest_categories = self._get(path)
+        interest_categories = self._get(path, params=with_projection(None, fields, exclude_fields))
         log.debug('{} interest category/ies returned'.format(len(interest_categories['categories'])))
         return interest_categories
 
-    def get_lists(self):
+    def get_lists(self, fields=None, exclude_fields=None):
         path = '/lists'
-        lists = self._get(path)
+        lists = self._get(path, params=with_projection(None, fields, exclude_fields))
         log.debug('{} list/s returned'.format(len(lists['lists'])))
         return lists
 
-    def get_member(self, subscriber_hash, list_id, use_cache=True):
+    def get_member(self, subscriber_hash, list_id, use_cache=True, fields=None, exclude_fields=None):
         """ Get member by subscriber hash.
         """
         path = '/lists/{}/members/{}'.format(list_id, subscriber_hash)
-        data = self._get(path, use_cache=use_cache)
+        data = self._get(path, params=with_projection(None, fields, exclude_fields), use_cache=use_cache)
         return data
 
-    def get_members(self, list_id, params=None):
+    def get_members(self, list_id, params=None, use_cache=True, fields=None, exclude_fields=None):
         """ Look up members by interest.
+
+        `fields` and `exclude_fields` are MailChimp field paths, e.g. 'members.email_address'.
         """
         path = '/lists/{}/members'.format(list_id)
-        data = self._get(path, params=params)
+        data = self._get(path, params=with_projection(params, fields, exclude_fields), use_cache=use_cache)
         return data
 
+    def iter_members(
+            self,
+            list_id,
+            params=None,
+            page_size=MEMBERS_PAGE_SIZE,
+            fields=None,
+            prefetch=False,
+            exclude_fields=None
+    ):
+        """
+        Yield every member matching the parameters, one page at a time.
+        :param list_id: basestring
+        :param params: dict of query parameters, as for get_members
+        :param page_size: number of members to request per page
+        :param fields: list of member fields to return (e.g. 'email_address'), or None for all
+        :param prefetch: whether to fetch the next page while the current one is being consumed
+        :param exclude_fields: list of member fields to leave out
+        :return: generator of member dicts
+        """
+        params = with_projection(
+            params,
+            ['total_items'] + ['members.{}'.format(f) for f in fields] if fields is not None else None,
+            ['members.{}'.format(f) for f in exclude_fields] if exclude_fields is not None else None
+        ) or {}
+
+        def fetch(offset):
+            page_params = dict(params, count=page_size, offset=offset)
+            return self.get_members(list_id, params=page_params, use_cache=False)
+
+        offset = 0
+        page = fetch(offset)
+        while True:
+            members = page['members']
+            offset += len(members)
+            has_next_page = len(members) > 0 and offset < page['total_items']
+            next_page = None
+            if has_next_page and prefetch:
+                next_page = _PageFetcher(fetch, offset)
+            for member in members:
+                yield member
+            if not has_next_page:
+                break
+            page = next_page.result() if next_page is not None else fetch(offset)
+
     def update_member(self, subscriber_hash, list_id, member):
         """ Patch member by subscriber hash.
         """
         path = '/lists/{}/members/{}'.format(list_id, subscriber_hash)
         data = self._patch(path, member)
+        self._forget_member(subscriber_hash, list_id)
+        mirror = self.mirrors.get(list_id)
+        if mirror is not None and 'email_address' in data:
+            mirror.put(data)
         return data
 
+    def create_batch(self, operations):
+        """ Submit a list of operations as one batch job.
+        """
+        data = self._post('/batches', {'operations': operations})
+        log.info('Batch {} submitted with {} operation/s'.format(data['id'], len(operations)))
+        return data
+
+    def get_batch(self, batch_id):
+        """ Get the status of a batch job.
+        """
+        path = '/batches/{}'.format(batch_id)
+        data = self._get(path, use_cache=False)
+        return data
+
+    def wait_for_batch(self, batch_id, poll_interval=BATCH_POLL_INTERVAL, timeout=BATCH_TIMEOUT):
+        """ Poll a batch job until it has finished, returning its final status.
+        """
+        deadline = time.time() + timeout
+        while True:
+            batch = self.get_batch(batch_id)
+            log.debug('Batch {} is {} ({}/{} operation/s finished)'.format(
+                batch_id,
+                batch['status'],
+                batch['finished_operations'],
+                batch['total_operations']
+            ))
+            if batch['status'] == 'finished':
+                return batch
+            if time.time() >= deadline:
+                raise BatchTimeoutException("Batch {} did not finish within {} seconds".format(batch_id, timeout))
+            time.sleep(poll_interval)
+
+    def get_batch_results(self, batch):
+        """ Download the results of a finished batch job, keyed by operation ID.
+
+        Each result is a dict with the HTTP status code and the decoded response body.
+        """
+        if not batch.get('response_body_url'):
+            return {}
+        resp = transport.get(batch['response_body_url'])
+        resp.raise_for_status()
+        results = {}
+        with tarfile.open(fileobj=io.BytesIO(resp.content), mode='r:gz') as archive:
+            for info in archive.getmembers():
+                if not info.isfile():
+                    continue
+                for item in json.load(archive.extractfile(info)):
+                    try:
+                        response = json.loads(item['response']) if item.get('response') else {}
+                    except ValueError:
+                        response = {'detail': item['response']}
+                    results[item['operation_id']] = {
+                        'status_code': item['status_code'],
+                        'response': response
+                    }
+        return results
+
     def _get(self, path, params=None, use_cache=True):
         url = '{}{}'.format(BASE_URL, path)
         log.debug(url)
+        if self.cache is None:
+            text, _ = self._fetch(url, params)
+            return json.loads(text)
+        # The cache is shared between clients, so keep accounts apart.
+        key = '{}:{}'.format(self._account_key(), cache.build_key(url, params))
+        fetch = lambda etag: self._fetch(url, params, etag=etag)
         if use_cache:
-            resp = requests.get(url, headers={'Authorization': 'Basic {}'.format(self.api_key)}, params=params)
+            ttl = self.cache.ttl_for(url, self.cache_timeout)
+            text = self.cache.get_or_fetch(key, fetch, ttl=ttl, conditional=True)
         else:
-            with requests_cache.disabled():
-                resp = requests.get(url, headers={'Authorization': 'Basic {}'.format(self.api_key)}, params=params)
+            # Still send the stored ETag: a 304 proves the local copy is current. Nothing new is cached.
+            text = self.cache.revalidate(key, fetch)
+        return json.loads(text)
+
+    def _forget_member(self, subscriber_hash, list_id):
+        """ Drop cached lookups of a member after it has been written.
+        """
+        _not_found.discard(self._not_found_key(subscriber_hash))
+        if self.cache is not None:
+            account_key = self._account_key()
+            self.cache.invalidate_prefix('{}:{}/search-members'.format(account_key, BASE_URL))
+            self.cache.invalidate_prefix(
+                '{}:{}/lists/{}/members/{}'.format(account_key, BASE_URL, list_id, subscriber_hash)
+            )
+
+    def _account_key(self):
+        return hashlib.md5(self.api_key or '').hexdigest()
+
+    def _not_found_key(self, subscriber_hash):
+        return '{}:{}'.format(self._account_key(), subscriber_hash)
+
+    def _fetch(self, url, params=None, etag=None):
+        """ GET a URL, returning the body and ETag, or None for the body if it still matches `etag`.
+        """
+        headers = {'Authorization': 'Basic {}'.format(self.api_key)}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        resp = self.session.get(url, headers=headers, params=params)
+        if etag is not None and resp.status_code == 304:
+            return None, etag
         resp.raise_for_status()
-        return resp.json()
+        return resp.text, resp.headers.get('ETag')
 
     def _patch(self, path, data):
         url = '{}{}'.format(BASE_URL, path)
         log.debug(url)
-        resp = requests.patch(url, headers={'Authorization': 'Basic {}'.format(self.api_key)}, json=data)
+        resp = self.session.patch(url, headers={'Authorization': 'Basic {}'.format(self.api_key)}, json=data)
+        resp.raise_for_status()
+        return resp.json()
+
+    def _post(self, path, data):
+        url = '{}{}'.format(BASE_URL, path)
+        log.debug(url)
+        resp = self.session.post(url, headers={'Authorization': 'Basic {}'.format(self.api_key)}, json=data)
         resp.raise_for_status()
         return resp.json()
 
@@ -149,49 +367,80 @@ class MailChimpInterestManager:
     list_id = ''
     interest_category_name = ''
     interest_category_id = ''
+    """:type : mirror.MailChimpMemberMirror"""
+    mirror = None
+    verify = VERIFY_RESPONSE
 
     def __init__(
             self,
             mc,
             list_name,
             interest_category_name,
+            mirror=None,
+            verify=VERIFY_RESPONSE,
     ):
         """
         
         :param mc: MailChimpClient
         :param list_name: basestring
         :param interest_category_name: basestring 
+        :param mirror: mirror.MailChimpMemberMirror of the list, or None to always ask MailChimp
+        :param verify: how interest changes are checked; one of the VERIFY_* values
         """
+        self.verify = verify
         self.mc = mc
         self.list_name = list_name
         self.list_id = mc.lookup_list_id(self.list_name)
         self.interest_category_name = interest_category_name
         self.interest_category_id = mc.lookup_interest_category_id(list_name, interest_category_name)
+        self.mirror = mirror
+        if mirror is not None:
+            mc.attach_mirror(mirror)
 
-    def get_member(self, email_address, use_cache=False):
+    def get_member(self, email_address, use_cache=False, fields=None):
         """ Get member by subscriber hash.
         """
+        if self.mirror is not None:
+            member = self.mirror.get(email_address)
+            if member is not None:
+                return member
         subscriber_hash = calculate_subscriber_hash(email_address)
-        data = self.mc.get_member(subscriber_hash, self.list_id, use_cache=use_cache)
+        data = self.mc.get_member(subscriber_hash, self.list_id, use_cache=use_cache, fields=fields)
         return data
 
     def lookup_interest_id(self, interest_name):
-        o = self.mc.get_interests(self.list_id, self.interest_category_id)
-        name_id_map = {l['name']: l['id'] for l in o['interests']}
-        return name_id_map.get(interest_name, False)
+        return self.mc.registry.lookup_interest_id_by_category(
+            self.mc,
+            self.list_id,
+            self.interest_category_id,
+            interest_name
+        )
 
-    def lookup_members_by_interest(self, interest_name):
+    def lookup_members_by_interest(self, interest_name, fields=None):
         """ Look up members by interest.
         """
+        members = list(self.iter_members_by_interest(interest_name, fields=fields))
+        return {
+            'members': members,
+            'total_items': len(members)
+        }
+
+    def iter_members_by_interest(self, interest_name, page_size=MEMBERS_PAGE_SIZE, fields=None, prefetch=False):
+        """
+        Yield every member with the specified interest, one page at a time.
+        :param interest_name: basestring
+        :param page_size: number of members to request per page
+        :param fields: list of member fields to return, or None for full member documents
+        :param prefetch: whether to fetch the next page while the current one is being consumed
+        :return: generator of member dicts
+        """
         interest_id = self.lookup_interest_id(interest_name)
         params = {
             'interest_category_id': self.interest_category_id,
             'interest_ids': interest_id,
             'interest_match': 'any'
         }
-        with requests_cache.disabled():
-            members = self.mc.get_members(self.list_id, params=params)
-        return members
+        return self.mc.iter_members(self.list_id, params=params, page_size=page_size, fields=fields, prefetch=prefetch)
 
     def add_interest(self, member_id, interest_name):
         """
@@ -211,6 +460,77 @@ class MailChimpInterestManager:
         """
         return self._toggle_interest(member_id, interest_name, False)
 
+    def bulk_update_interests(self, changes, poll_interval=BATCH_POLL_INTERVAL, timeout=BATCH_TIMEOUT):
+        """
+        Apply interest changes to many members in a single batch job.
+        :param changes: dict of member ID to a dict of interest name to boolean
+        :param poll_interval: number of seconds between batch status checks
+        :param timeout: number of seconds to wait for the batch to finish
+        :return: dict of member ID to a dict with 'ok', 'status_code' and 'response'
+        """
+        if not changes:
+            return {}
+        operations = []
+        for member_id, interests in changes.items():
+            body = {
+                'interests': {self.lookup_interest_id(name): toggle for name, toggle in interests.items()}
+            }
+            operations.append({
+                'method': 'PATCH',
+                'path': '/lists/{}/members/{}'.format(self.list_id, member_id),
+                'operation_id': member_id,
+                'body': json.dumps(body)
+            })
+        batch = self.mc.create_batch(operations)
+        batch = self.mc.wait_for_batch(batch['id'], poll_interval=poll_interval, timeout=timeout)
+        log.info('Batch {} finished: {} operation/s, {} errored'.format(
+            batch['id'],
+            batch['total_operations'],
+            batch['errored_operations']
+        ))
+        batch_results = self.mc.get_batch_results(batch)
+        results = {}
+        for member_id in changes:
+            result = batch_results.get(member_id, {'status_code': None, 'response': {}})
+            result['ok'] = result['status_code'] is not None and 200 <= result['status_code'] < 300
+            if result['ok']:
+                self.mc._forget_member(member_id, self.list_id)
+            if result['ok'] and self.mirror is not None and 'email_address' in result['response']:
+                self.mirror.put(result['response'])
+            results[member_id] = result
+        return results
+
+    def set_interests(self, member_id, interests, verify=None):
+        """
+        Set several interests on member data with a single PATCH.
+        :param member_id: basestring
+        :param interests: dict of interest name to boolean
+        :param verify: one of the VERIFY_* values, or None to use the manager's default
+        :return: the member data returned by the verification, or the PATCH response
+        """
+        if verify is None:
+            verify = self.verify
+        interest_ids = {self.lookup_interest_id(name): toggle for name, toggle in interests.items()}
+        obj = {
+            'interests': interest_ids
+        }
+        member = self.mc.update_member(member_id, self.list_id, obj)
+        if verify == VERIFY_NONE:
+            return member
+        if verify == VERIFY_REFETCH:
+            member = self.mc.get_member(member_id, self.list_id, use_cache=False, fields=['id', 'interests'])
+        for interest_id, toggle in interest_ids.items():
+            if member.get('interests', {}).get(interest_id) is not toggle:
+                log.error("Interest not updated: interest_id={}, member={}, toggle={}".format(
+                    interest_id,
+                    member,
+                    toggle
+                ))
+                raise InterestVerificationException(
+                    "Interest {} of member {} was not set to {}".format(interest_id, member_id, toggle)
+                )
+        return member
+
     def _toggle_interest(self, member_id, interest_name, toggle):
         """
         Toggle specified interest from member data.
@@ -219,34 +539,47 @@ class MailChimpInterestManager:
         :param toggle: boolean
         :return: 
         """
-        interest_id = self.lookup_interest_id(interest_name)
-        obj = {
-            'interests': {
-                interest_id: toggle
-            }
-        }
-        self.mc.update_member(member_id, self.list_id, obj)
-        with requests_cache.disabled():
-            member = self.mc.get_member(member_id, self.list_id)
+        return self.set_interests(member_id, {interest_name: toggle})
+
+
+class _PageFetcher:
+
+    """ Fetch one page in a background thread.
+    """
+
+    def __init__(self, fetch, offset):
+        self._page = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(fetch, offset))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, fetch, offset):
         try:
-            assert member['interests'][interest_id] is toggle
-        except KeyError as ke:
-            log.error("KeyError: message={}, interest_id={}, member={}, toggle={}".format(
-                ke.message,
-                interest_id,
-                member,
-                toggle
-            ))
-            raise ke
-        except AssertionError as ae:
-            log.error("AssertionError: message={}, interest_id={}, member={}, toggle={}".format(
-                ae.message,
-                interest_id,
-                member,
-                toggle
-            ))
-            raise ae
-        return member
+            self._page = fetch(offset)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._page
+
+
+def with_projection(params, fields=None, exclude_fields=None):
+    """ Return a copy of the query parameters with MailChimp's fields/exclude_fields projection added.
+    """
+    params = dict(params or {})
+    if fields:
+        params['fields'] = ','.join(fields)
+    if exclude_fields:
+        params['exclude_fields'] = ','.join(exclude_fields)
+    return params or None
+
+
+def normalize_email(email_address):
+    return email_address.strip().lower()
 
 
 def calculate_subscriber_hash(email_address):
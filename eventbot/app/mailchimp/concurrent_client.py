@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+
+import eventbot.integrations.defaults
+from eventbot.app.mailchimp.api_client import MailChimpClient, MailChimpInterestManager
+from eventbot.integrations.ratelimit import RateLimiter
+
+log = logging.getLogger(__name__)
+
+
+class ConcurrentMailChimpClient:
+
+    """ Counterpart of MailChimpClient whose calls run on a pool of worker threads.
+
+    Each method takes the same arguments as its MailChimpClient namesake and returns an
+    AsyncResult; call `.get()` on it for the value. At most `concurrency` requests are in
+    flight at once (MailChimp allows 10 simultaneous connections per API key), sharing the
+    transport's keep-alive connection pool for the MailChimp host. With `rate_limit` set, at
+    most that many submitted calls start per second.
+    """
+
+    """:type : MailChimpClient"""
+    mc = None
+    concurrency = 0
+
+    def __init__(
+            self,
+            api_key,
+            concurrency=eventbot.integrations.defaults.MAILCHIMP_MAX_CONNECTIONS,
+            rate_limit=None,
+            **kwargs
+    ):
+        """
+
+        :param api_key: basestring
+        :param concurrency: maximum number of requests in flight
+        :param rate_limit: maximum number of submitted calls to start per second, or None for no limit
+        :param kwargs: passed on to MailChimpClient
+        """
+        self.concurrency = concurrency
+        self.mc = MailChimpClient(api_key, **kwargs)
+        self._rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._pool = ThreadPool(concurrency)
+
+    def submit(self, fn, *args, **kwargs):
+        """ Run a function on the pool, holding one of the connection slots while it runs.
+        """
+        return self._pool.apply_async(self._call, (fn, args, kwargs))
+
+    def map(self, fn, iterable):
+        """ Apply a function to every item concurrently, returning the results in order.
+        """
+        return [result.get() for result in [self.submit(fn, item) for item in iterable]]
+
+    def check_interest(self, email, list_name, interest_category_name, interest_name):
+        return self.submit(self.mc.check_interest, email, list_name, interest_category_name, interest_name)
+
+    def search(self, email, alldata=False, fields=None, exclude_fields=None):
+        return self.submit(self.mc.search, email, alldata=alldata, fields=fields, exclude_fields=exclude_fields)
+
+    def get_member(self, subscriber_hash, list_id, use_cache=True, fields=None, exclude_fields=None):
+        return self.submit(
+            self.mc.get_member,
+            subscriber_hash,
+            list_id,
+            use_cache=use_cache,
+            fields=fields,
+            exclude_fields=exclude_fields
+        )
+
+    def get_members(self, list_id, params=None, use_cache=True, fields=None, exclude_fields=None):
+        return self.submit(
+            self.mc.get_members,
+            list_id,
+            params=params,
+            use_cache=use_cache,
+            fields=fields,
+            exclude_fields=exclude_fields
+        )
+
+    def update_member(self, subscriber_hash, list_id, member):
+        return self.submit(self.mc.update_member, subscriber_hash, list_id, member)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def _call(self, fn, args, kwargs):
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire()
+        with self._semaphore:
+            return fn(*args, **kwargs)
+
+
+class ConcurrentMailChimpInterestManager:
+
+    """ Counterpart of MailChimpInterestManager whose calls run on a ConcurrentMailChimpClient's pool.
+    """
+
+    """:type : ConcurrentMailChimpClient"""
+    client = None
+    """:type : MailChimpInterestManager"""
+    manager = None
+
+    def __init__(self, client, list_name, interest_category_name, **kwargs):
+        """
+
+        :param client: ConcurrentMailChimpClient
+        :param list_name: basestring
+        :param interest_category_name: basestring
+        :param kwargs: passed on to MailChimpInterestManager
+        """
+        self.client = client
+        self.manager = MailChimpInterestManager(client.mc, list_name, interest_category_name, **kwargs)
+
+    @property
+    def list_id(self):
+        return self.manager.list_id
+
+    def get_member(self, email_address, use_cache=False, fields=None):
+        return self.client.submit(self.manager.get_member, email_address, use_cache=use_cache, fields=fields)
+
+    def set_interests(self, member_id, interests, verify=None):
+        return self.client.submit(self.manager.set_interests, member_id, interests, verify=verify)
+
+    def add_interest(self, member_id, interest_name):
+        return self.client.submit(self.manager.add_interest, member_id, interest_name)
+
+    def remove_interest(self, member_id, interest_name):
+        return self.client.submit(self.manager.remove_interest, member_id, interest_name)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import datetime
+import logging
+import threading
+
+from eventbot.app.mailchimp.api_client import (
+    MEMBERS_PAGE_SIZE,
+    MIRROR_MEMBER_FIELDS,
+    calculate_subscriber_hash,
+    normalize_email
+)
+
+log = logging.getLogger(__name__)
+
+
+class MailChimpMemberMirror:
+
+    """ Local copy of a MailChimp list's members, indexed by subscriber hash and by email.
+
+    The first sync pages through the whole members collection; later syncs only fetch members
+    changed since the previous sync. Members deleted or archived in MailChimp are not reported
+    by delta syncs, so use `sync(full=True)` to drop them.
+    """
+
+    mc = None
+    list_id = ''
+    page_size = MEMBERS_PAGE_SIZE
+    last_synced = None
+
+    def __init__(self, mc, list_id, page_size=MEMBERS_PAGE_SIZE):
+        """
+
+        :param mc: MailChimpClient
+        :param list_id: basestring
+        :param page_size: number of members to request per page
+        """
+        self.mc = mc
+        self.list_id = list_id
+        self.page_size = page_size
+        self.last_synced = None
+        self._members_by_hash = {}
+        self._hashes_by_email = {}
+        self._lock = threading.Lock()
+
+    def sync(self, full=False):
+        """ Bring the mirror up to date, returning the number of members fetched.
+
+        The members are collected before the mirror is changed, so that readers never see a partly
+        synced mirror and a failed sync leaves the previous copy in place.
+        """
+        started = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        full = full or self.last_synced is None
+        params = {}
+        if not full:
+            params['since_last_changed'] = self.last_synced
+        members = list(self.mc.iter_members(
+            self.list_id,
+            params=params,
+            page_size=self.page_size,
+            fields=MIRROR_MEMBER_FIELDS
+        ))
+        if full:
+            members_by_hash = {}
+            hashes_by_email = {}
+            for member in members:
+                _put(members_by_hash, hashes_by_email, member)
+            with self._lock:
+                self._members_by_hash = members_by_hash
+                self._hashes_by_email = hashes_by_email
+        else:
+            with self._lock:
+                for member in members:
+                    _put(self._members_by_hash, self._hashes_by_email, member)
+        self.last_synced = started
+        log.debug('Mirror of list_id={} synced: {} member(s) fetched, {} held'.format(
+            self.list_id,
+            len(members),
+            len(self)
+        ))
+        return len(members)
+
+    def put(self, member):
+        """ Add or replace a member in the mirror.
+        """
+        with self._lock:
+            _put(self._members_by_hash, self._hashes_by_email, member)
+
+    def get(self, email_address):
+        """ Get member by email address, or None if the member is not in the mirror.
+        """
+        subscriber_hash = self._hashes_by_email.get(normalize_email(email_address))
+        if subscriber_hash is None:
+            subscriber_hash = calculate_subscriber_hash(normalize_email(email_address))
+        return self._members_by_hash.get(subscriber_hash)
+
+    def get_by_hash(self, subscriber_hash):
+        """ Get member by subscriber hash, or None if the member is not in the mirror.
+        """
+        return self._members_by_hash.get(subscriber_hash)
+
+    def __contains__(self, email_address):
+        return self.get(email_address) is not None
+
+    def __len__(self):
+        return len(self._members_by_hash)
+
+
+def _put(members_by_hash, hashes_by_email, member):
+    subscriber_hash = member.get('id') or calculate_subscriber_hash(member['email_address'])
+    old_member = members_by_hash.get(subscriber_hash)
+    if old_member is not None:
+        hashes_by_email.pop(normalize_email(old_member['email_address']), None)
+    members_by_hash[subscriber_hash] = member
+    hashes_by_email[normalize_email(member['email_address'])] = subscriber_hash
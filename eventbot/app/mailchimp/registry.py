@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import logging
+import threading
+import time
+
+LIST_FIELDS = ['lists.id', 'lists.name']
+INTEREST_CATEGORY_FIELDS = ['categories.id', 'categories.title']
+INTEREST_FIELDS = ['interests.id', 'interests.name']
+
+log = logging.getLogger(__name__)
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+class MailChimpMetadataRegistry:
+
+    """ In-process registry of MailChimp list, interest category and interest name->ID maps.
+
+    The maps are fetched through the client passed to each lookup and served from memory until
+    they are older than the client's `metadata_timeout`, or until they are explicitly invalidated.
+    The registry keeps no client, so every client sharing it keeps its own settings.
+    """
+
+    hits = 0
+    misses = 0
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def lookup_list_id(self, mc, list_name):
+        """
+        :param mc: MailChimpClient to load the map through, if necessary
+        """
+        name_id_map = self._get_map(mc, ('lists',), lambda: self._load_lists(mc))
+        return name_id_map.get(list_name, False)
+
+    def lookup_interest_category_id(self, mc, list_name, interest_category_name):
+        list_id = self.lookup_list_id(mc, list_name)
+        name_id_map = self._get_map(
+            mc,
+            ('categories', list_id),
+            lambda: self._load_interest_categories(mc, list_id)
+        )
+        return name_id_map.get(interest_category_name, False)
+
+    def lookup_interest_id(self, mc, list_name, interest_category_name, interest_name):
+        list_id = self.lookup_list_id(mc, list_name)
+        interest_category_id = self.lookup_interest_category_id(mc, list_name, interest_category_name)
+        return self.lookup_interest_id_by_category(mc, list_id, interest_category_id, interest_name)
+
+    def lookup_interest_id_by_category(self, mc, list_id, interest_category_id, interest_name):
+        name_id_map = self._get_map(
+            mc,
+            ('interests', list_id, interest_category_id),
+            lambda: self._load_interests(mc, list_id, interest_category_id)
+        )
+        return name_id_map.get(interest_name, False)
+
+    def invalidate(self, list_id=None):
+        """ Drop cached maps, either all of them or only those belonging to one list.
+        """
+        with self._lock:
+            if list_id is None:
+                self._maps.clear()
+            else:
+                for key in [k for k in self._maps if len(k) > 1 and k[1] == list_id]:
+                    del self._maps[key]
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._maps),
+        }
+
+    def _get_map(self, mc, key, loader):
+        with self._lock:
+            entry = self._maps.get(key)
+            if entry is not None and time.time() - entry[0] < mc.metadata_timeout:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        name_id_map = loader()
+        with self._lock:
+            self._maps[key] = (time.time(), name_id_map)
+        log.debug('Registry loaded {} ({} entries)'.format(key, len(name_id_map)))
+        return name_id_map
+
+    def _load_lists(self, mc):
+        o = mc.get_lists(fields=LIST_FIELDS)
+        return {l['name']: l['id'] for l in o['lists']}
+
+    def _load_interest_categories(self, mc, list_id):
+        o = mc.get_interest_categories(list_id, fields=INTEREST_CATEGORY_FIELDS)
+        return {l['title']: l['id'] for l in o['categories']}
+
+    def _load_interests(self, mc, list_id, interest_category_id):
+        o = mc.get_interests(list_id, interest_category_id, fields=INTEREST_FIELDS)
+        return {l['name']: l['id'] for l in o['interests']}
+
+
+def get_registry(api_key):
+    """ Return the process-wide registry for an API key, creating it if necessary.
+
+    Clients are usually constructed per request, so the registry is shared between all
+    clients using the same API key.
+    """
+    with _registries_lock:
+        registry = _registries.get(api_key)
+        if registry is None:
+            registry = MailChimpMetadataRegistry()
+            _registries[api_key] = registry
+    return registry
+
+
+def invalidate_all():
+    """ Invalidate every registry in the process.
+    """
+    with _registries_lock:
+        for registry in _registries.values():
+            registry.invalidate()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+import logging
+import re
+from collections import Counter, OrderedDict
+
+from eventbot import settings
+from eventbot.app.eventbrite import attendee_store
+from eventbot.app.mailchimp.api_client import (
+    MailChimpClient,
+    MailChimpInterestManager,
+    calculate_subscriber_hash,
+    normalize_email
+)
+
+log = logging.getLogger(__name__)
+
+
+class MailChimpSegments:
+
+    """ Subscriber hashes of a list's members, overall and per interest, loaded in a few paged requests.
+    """
+
+    """:type : set"""
+    members = None
+    """:type : dict"""
+    interests = None
+
+    def __init__(self, members, interests):
+        """
+
+        :param members: set of the subscriber hashes of every member of the list
+        :param interests: dict of interest name -> set of subscriber hashes
+        """
+        self.members = members
+        self.interests = interests
+
+    @classmethod
+    def load(
+            cls,
+            manager,
+            interest_names=(settings.MAILCHIMP_INTEREST_NAME_MEMBER, settings.MAILCHIMP_INTEREST_NAME_SOCIALITE)
+    ):
+        """
+        Load the list's members and interest segments through an interest manager.
+        :param manager: MailChimpInterestManager
+        :param interest_names: names of the interests to load
+        :return: MailChimpSegments
+        """
+        members = set(m['id'] for m in manager.mc.iter_members(manager.list_id, fields=['id'], prefetch=True))
+        interests = {}
+        for interest_name in interest_names:
+            interests[interest_name] = set(
+                m['id'] for m in manager.iter_members_by_interest(interest_name, fields=['id'], prefetch=True)
+            )
+        log.debug("Loaded {} member(s) and interest segments {}".format(
+            len(members),
+            {k: len(v) for k, v in interests.items()}
+        ))
+        return cls(members, interests)
+
+    def has_interest(self, subscriber_hash, interest_name):
+        return subscriber_hash in self.interests.get(interest_name, ())
+
+
+class DuplicateIndex:
+
+    """ Index of attendees' canonical email addresses (see canonical_email) across events.
+    """
+
+    def __init__(self):
+        self._events_by_email = {}
+        self._duplicates_by_event = {}
+
+    def add(self, event_id, email_address):
+        email_address = canonical_email(email_address)
+        events = self._events_by_email.setdefault(email_address, Counter())
+        events[event_id] += 1
+        if events[event_id] == 2:
+            self._duplicates_by_event.setdefault(event_id, set()).add(email_address)
+
+    def within(self, event_id):
+        """ Return the canonical email addresses that occur more than once in one event.
+        """
+        return sorted(self._duplicates_by_event.get(event_id, ()))
+
+    def across(self):
+        """ Return a dict of canonical email address -> event IDs, for addresses found in more than one event.
+        """
+        return {e: sorted(events) for e, events in self._events_by_email.items() if len(events) > 1}
+
+
+def reconcile(attendees, segments, index=None, event_id=None):
+    """
+    Check attendees against MailChimp segments in a single pass.
+    :param attendees: iterable of Attendee records
+    :param segments: MailChimpSegments
+    :param index: DuplicateIndex to add the attendees to, e.g. to find duplicates across events
+    :param event_id: the ID of the event the attendees belong to, for the index
+    :return: report dict, as built by build_report
+    """
+    if index is None:
+        index = DuplicateIndex()
+    results = []
+    for a in attendees:
+        index.add(event_id, a.email)
+        subscriber_hash = calculate_subscriber_hash(normalize_email(a.email))
+        found = subscriber_hash in segments.members
+        results.append(build_result(
+            a,
+            found=found,
+            is_member=found and segments.has_interest(subscriber_hash, settings.MAILCHIMP_INTEREST_NAME_MEMBER),
+            is_socialite=found and segments.has_interest(subscriber_hash, settings.MAILCHIMP_INTEREST_NAME_SOCIALITE)
+        ))
+    return build_report(results, index.within(event_id))
+
+
+def reconcile_events(eb, segments, statuses=['live'], full=False):
+    """
+    Reconcile the attendees of every event with one of the statuses, sharing the MailChimp segments.
+    :param eb: EventbriteClient
+    :param segments: MailChimpSegments
+    :param statuses: event statuses, as for EventbriteClient.get_event_snippets
+    :param full: whether to download every attendee rather than only changes
+    :return: dict with a report per event under 'events' (in event order) and the addresses
+        found in more than one event under 'duplicates'
+    """
+    store = attendee_store.get_store()
+    index = DuplicateIndex()
+    reports = OrderedDict()
+    for snippet in eb.get_event_snippets(statuses):
+        store.sync(eb, snippet['id'], full=full)
+        reports[snippet['id']] = reconcile(store.iter_attendees(snippet['id']), segments, index, snippet['id'])
+        reports[snippet['id']]['name'] = snippet['name']
+    return {
+        'events': reports,
+        'duplicates': index.across(),
+    }
+
+
+def reconcile_with_mailchimp(attendees):
+    """ Load the MailChimp segments for the default list and reconcile attendees against them.
+    """
+    return reconcile(attendees, load_default_segments())
+
+
+def load_default_segments():
+    """ Load the member and socialite segments of the default MailChimp list.
+    """
+    manager = MailChimpInterestManager(
+        MailChimpClient(settings.MAILCHIMP_APIKEY),
+        settings.MAILCHIMP_DEFAULT_LIST,
+        settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY
+    )
+    return MailChimpSegments.load(manager)
+
+
+def build_result(a, found, is_member, is_socialite):
+    """ Build the report entry for one attendee.
+    """
+    o = {
+        'email': a.email,
+        'found': found,
+        'is_socialite': is_socialite,
+        'is_member': is_member,
+        'has_correct_ticket': True
+    }
+    if found:
+        if is_member and is_socialite:
+            log.warn("Attendee {} is marked as a member and a socialite!".format(a.email))
+        if is_member and a.ticket_class_name.lower() == 'socialite'\
+                or is_socialite and a.ticket_class_name.lower() == 'member':
+            o['has_correct_ticket'] = False
+    return o
+
+
+def build_report(results, duplicates, errors=None):
+    """ Build the attendee report from per-attendee results and the duplicate email addresses.
+
+    :param errors: list of {'email', 'error'} dicts for attendees that could not be checked
+    """
+    errors = errors or []
+    return {
+        'attendees': results,
+        'duplicates': duplicates,
+        'errors': errors,
+        'totals': {
+            'attendees': len(results),
+            'socialites': len([a for a in results if a['is_socialite'] is True]),
+            'members': len([a for a in results if a['is_member'] is True]),
+            'duplicates': len(duplicates),
+            'not_found': len([a for a in results if a['found'] is False]),
+            'incorrect_ticket': len([a for a in results if a['has_correct_ticket'] is False]),
+            'errors': len(errors),
+        }
+    }
+
+
+def canonical_email(email_address):
+    """ Reduce an email address to the form used to spot the same person twice.
+
+    Case and whitespace are ignored, as is a '+tag' after the local part.
+    """
+    local_part, _, domain = re.sub(r'\s+', '', email_address).lower().rpartition('@')
+    if not local_part:
+        return domain
+    return '{}@{}'.format(local_part.split('+', 1)[0] or local_part, domain)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import logging
+import random
+import time
+
+import simplejson as json
+from flask import g, request
+
+import eventbot.integrations.defaults
+
+HTTP_HEADER_REQUEST_ID = 'X-Request-ID'
+REDACTED = '[redacted]'
+
+log = logging.getLogger(__name__)
+
+
+class RequestLogger:
+
+    """ Logs one structured line per request from Flask's before_request and after_request hooks.
+
+    Nothing is read from the request unless the line will be emitted: the level is checked and the
+    request sampled first, and the line itself is only built when a handler formats it. Failed
+    requests (status 500 and above) are logged whatever the sample rate.
+    """
+
+    """:type : logging.Logger"""
+    logger = None
+    level = logging.DEBUG
+    sample_rate = 1.0
+    max_body_length = 0
+    """:type : set"""
+    redacted_fields = None
+    """:type : set"""
+    redacted_headers = None
+
+    def __init__(
+            self,
+            logger=log,
+            level=logging.DEBUG,
+            sample_rate=eventbot.integrations.defaults.REQUEST_LOG_SAMPLE_RATE,
+            max_body_length=eventbot.integrations.defaults.REQUEST_LOG_BODY_MAX_LENGTH,
+            redacted_fields=eventbot.integrations.defaults.REQUEST_LOG_REDACTED_FIELDS,
+            redacted_headers=eventbot.integrations.defaults.REQUEST_LOG_REDACTED_HEADERS
+    ):
+        """
+
+        :param logger: logger the lines are written to
+        :param level: level the lines are written at
+        :param sample_rate: fraction of requests to log, from 0 to 1
+        :param max_body_length: number of characters of the body to log; 0 leaves the body out
+        :param redacted_fields: names of form and JSON fields whose values are replaced, case-insensitively
+        :param redacted_headers: names of headers whose values are replaced, case-insensitively
+        """
+        self.logger = logger
+        self.level = level
+        self.sample_rate = sample_rate
+        self.max_body_length = max_body_length
+        self.redacted_fields = set(f.lower() for f in redacted_fields)
+        self.redacted_headers = set(h.lower() for h in redacted_headers)
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        g.request_log_started_at = time.time()
+        g.request_log_sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def after_request(self, response):
+        if not self.logger.isEnabledFor(self.level):
+            return response
+        if not (getattr(g, 'request_log_sampled', False) or response.status_code >= 500):
+            return response
+        self.logger.log(self.level, '%s', RequestLogLine(self, request._get_current_object(), response, {
+            'request_id': request.headers.get(HTTP_HEADER_REQUEST_ID),
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': int((time.time() - getattr(g, 'request_log_started_at', time.time())) * 1000),
+            'response_length': response.content_length,
+        }))
+        return response
+
+    def redact(self, data):
+        """ Replace the values of redacted fields in a (possibly nested) dict or list.
+        """
+        if isinstance(data, dict):
+            return {
+                k: REDACTED if k.lower() in self.redacted_fields else self.redact(v)
+                for k, v in data.items()
+            }
+        if isinstance(data, list):
+            return [self.redact(v) for v in data]
+        if isinstance(data, basestring) and data.startswith('{'):
+            # e.g. the JSON payload Slack sends in a form field
+            try:
+                return self.redact(json.loads(data))
+            except ValueError:
+                return data
+        return data
+
+    def truncate(self, text):
+        if len(text) <= self.max_body_length:
+            return text
+        return u'{}... ({} more characters)'.format(text[:self.max_body_length], len(text) - self.max_body_length)
+
+
+class RequestLogLine:
+
+    """ One request's log line, built only when it is formatted.
+    """
+
+    def __init__(self, request_logger, req, response, fields):
+        self.request_logger = request_logger
+        self.request = req
+        self.response = response
+        self.fields = fields
+
+    def __str__(self):
+        request_logger = self.request_logger
+        fields = dict(self.fields)
+        if self.request.args:
+            fields['query'] = request_logger.redact(self.request.args.to_dict())
+        fields['headers'] = {
+            k: REDACTED if k.lower() in request_logger.redacted_headers else v
+            for k, v in self.request.headers.items()
+            if k.lower() != HTTP_HEADER_REQUEST_ID.lower()
+        }
+        if request_logger.max_body_length:
+            body = self._body()
+            if body:
+                fields['body'] = request_logger.truncate(body)
+        return 'request {}'.format(json.dumps(fields, sort_keys=True))
+
+    def _body(self):
+        """ Get the redacted request body as text.
+        """
+        if self.request.form:
+            return json.dumps(self.request_logger.redact(self.request.form.to_dict()), sort_keys=True)
+        data = self.request.get_json(silent=True, cache=True)
+        if data is not None:
+            return json.dumps(self.request_logger.redact(data), sort_keys=True)
+        return self.request.get_data(cache=True).decode('utf-8', 'replace')
@@ -1,18 +1,15 @@
+import functools
 import logging
 import pprint
-import requests
-import simplejson as json
-from flask import jsonify, request
+from flask import g, jsonify, request
 from . import app
 import eventbot.settings
-import urllib
-# from attendee_reporter import check_membership
+from eventbot.app import tasks
+from eventbot.integrations import jobs, transport
 from errors import InvalidUsage
-from slack import api_client as slack
 from slack import action as slack_action
 from forms import ApplicationForm
-
-HTTP_HEADER_REQUEST_ID = 'X-Request-ID'
+from request_logging import HTTP_HEADER_REQUEST_ID
 
 log = logging.getLogger(__name__)
 
@@ -22,16 +19,67 @@ ROUTES_WEB_HOOK_APPLICATION_FORM = '/webhook/application_form'
 ROUTES_WEB_HOOK_EVENTBRITE = '/webhook/eventbrite'
 ROUTES_WEB_HOOK_SLACK_SLASH_COMMAND_ATTENDEES = '/webhook/slack/command/attendees'
 
+EVENTBRITE_ACTION_ATTENDEE_UPDATED = 'attendee.updated'
+
 
-def log_request():
-    """ Log request details.
+def deduplicated(delivery_key):
+    """ Decorator answering a redelivered webhook with the response to its first delivery.
+
+    Deliveries are identified by the sender's own delivery ID, as returned by `delivery_key`.
+    The X-Request-ID header is only used when there is none, because routers such as Heroku's
+    set a new one on every request, retries included. Only successful responses are remembered,
+    so failed deliveries are still retried in full.
+    :param delivery_key: function returning the ID of the current request's delivery, or None
+    """
+    def wrap(fn):
+        @functools.wraps(fn)
+        def handle(*args, **kwargs):
+            key = delivery_key() or request.headers.get(HTTP_HEADER_REQUEST_ID)
+            if not key:
+                return fn(*args, **kwargs)
+            key = u'{}:{}'.format(request.path, key)
+            store = app.extensions['dedup']
+            cached = store.get(key)
+            if cached is not None:
+                log.info(u"Answering repeat delivery {} from the dedup store".format(key))
+                status, mimetype, body = cached
+                return app.response_class(body, status=status, mimetype=mimetype)
+            resp = app.make_response(fn(*args, **kwargs))
+            if 200 <= resp.status_code < 300:
+                store.put(key, resp.status_code, resp.mimetype, resp.get_data())
+            return resp
+        return handle
+    return wrap
+
+
+def _wufoo_entry_id():
+    return request.form.get('EntryId')
+
+
+def _eventbrite_delivery():
+    request_data = request.get_json(silent=True) or {}
+    if not request_data.get('api_url'):
+        return None
+    return u'{}:{}'.format(request_data.get('config', {}).get('action'), request_data['api_url'])
+
+
+def _slack_command_trigger_id():
+    return request.form.get('trigger_id')
+
+
+def _slack_action_payload():
+    """ Parse the current Slack action request's payload, once per request.
     """
-    request_id = request.headers.get(HTTP_HEADER_REQUEST_ID, 'unknown')
-    log.debug(u"request_id='{}'".format(request_id))
-    log.debug(u"headers='{}'".format(str(request.headers).replace('\r\n', ',')))
-    log.debug(u"query_string='{}'".format(request.query_string))
-    log.debug(u"body='{}'".format(request.get_data().decode('utf-8')))
-    return request_id
+    if 'slack_action_payload' not in g:
+        g.slack_action_payload = slack_action.parse_payload(request.get_data().decode('utf-8'))
+    return g.slack_action_payload
+
+
+def _slack_action_trigger_id():
+    try:
+        return _slack_action_payload().get('trigger_id')
+    except (IndexError, ValueError):
+        return None
 
 
 @app.route("/")
@@ -51,7 +99,6 @@ def command():
 def action():
     """ Processes actions from interactive message button presses.
     """
-    log_request()
     pass
 
 
@@ -59,7 +106,6 @@ def action():
 def oauth():
     """ Verify an OAuth request.
     """
-    log_request()
     code = request.args.get('code')
     if not code:
         log.error("No code specified")
@@ -72,17 +118,23 @@ def oauth():
             "client_id": eventbot.settings.SLACK_CLIENT_ID,
             "client_secret": eventbot.settings.SLACK_CLIENT_SECRET
         }
-        resp = requests.get(url, params=payload)
+        resp = transport.get(url, params=payload)
         return jsonify(**resp.json())
 
 
 @app.route(ROUTES_WEB_HOOK_SLACK_SLASH_COMMAND_ATTENDEES, methods=['POST'])
+@deduplicated(_slack_command_trigger_id)
 def web_hook_slack_slash_command_attendees():
     """ For processing '/attendees' commands.
+
+    Slack waits only three seconds for an answer, so when the command comes with a response_url
+    the list is built in the background and posted there.
     """
-    # request_id = log_request()
     post_data = request.form
-    log.debug(post_data)
+    if post_data.get('response_url') and post_data['command'][1:] == 'attendees':
+        event_id = post_data['text'].split(' ')[0]  # the first argument
+        jobs.enqueue(tasks.TASK_POST_ATTENDEES, post_data['user_name'], event_id, post_data['response_url'])
+        return 'Fetching the attendee list, {}...'.format(post_data['user_name'])
     return slack_action.parse_slash_command(
         post_data['command'],
         post_data['user_name'],
@@ -92,62 +144,61 @@ def web_hook_slack_slash_command_attendees():
 
 
 @app.route("/slack/action-endpoint", methods=['POST', 'GET'])
+@deduplicated(_slack_action_trigger_id)
 def web_hook_slack_action_endpoint():
     """ Receives requests from Slack when someone presses a button in an interactive message.
+
+    The approval runs in the background; the message is replaced with the outcome through the
+    payload's response_url. Presses for an approval that is already running are ignored.
     """
-    request_id = log_request()
-    data = request.get_data().decode('utf-8')
-    resp = slack_action.parse_post(data)
-    log.debug(u"request_id={} d: {}".format(request_id, json.dumps(data)))
-    user = resp['payload']['user']['name']
-    email = resp['payload']['callback_id']
-    original_message_text = resp['payload']['original_message']['text']
-    log.info(u"{} successfully approved {}".format(user, email))
-    message = u"""
-{}
-
-*Successful approval by {}.*
-""".format(
-        urllib.unquote_plus(original_message_text),
-        user
+    payload = _slack_action_payload()
+    user = payload['user']['name']
+    email = payload['callback_id']
+    original_message_text = payload['original_message']['text']
+    # Keyed on the callback ID, so that presses handled by any process sharing the queue are coalesced.
+    job_id = jobs.enqueue_unique(
+        tasks.TASK_APPROVE_SOCIALITE,
+        email,
+        email,
+        user,
+        original_message_text,
+        payload['response_url']
     )
-    return message
+    if job_id is None:
+        log.info(u"{} pressed approve for {} while its approval was in progress".format(user, email))
+        return slack_action.format_approval_message(original_message_text, u"*Approval already in progress...*")
+    return slack_action.format_approval_message(original_message_text, u"*Approval by {} in progress...*".format(user))
 
 
 @app.route(ROUTES_WEB_HOOK_APPLICATION_FORM, methods=['POST', 'GET'])
+@deduplicated(_wufoo_entry_id)
 def web_hook_application_form():
     """ Web hook for incoming application forms.
     """
-    request_id = log_request()
-    log.info(u"request_id={} Received form: {}".format(request_id, request.form))
     data = request.form.to_dict()
-    log.debug(u"request_id={} Data: {}".format(request_id, data))
-    form = ApplicationForm(data=data)
+    # Build the form here so that a malformed submission is still rejected straight away.
+    ApplicationForm(data=data)
     d = {
         'status': 'ok',
         'form': request.form,
         'data': data,
     }
-    slack.post_form_to_webhook(form)
-    log.debug(u"request_id={} d: {}".format(request_id, json.dumps(d)))
+    jobs.enqueue(tasks.TASK_POST_APPLICATION_FORM, data)
     return jsonify(**d)
 
 
 @app.route(ROUTES_WEB_HOOK_EVENTBRITE, methods=['POST', 'GET'])
+@deduplicated(_eventbrite_delivery)
 def web_hook_eventbrite():
     """ Web hook for incoming Eventbrite changes.
     """
-    request_id = log_request()
     request_data = request.get_json()
-    # if request_data['config']['action'] == 'attendee.updated':
-    #     log.info("Order placed!")
-    #     check_membership(request_data['api_url'])
+    if (request_data or {}).get('config', {}).get('action') == EVENTBRITE_ACTION_ATTENDEE_UPDATED:
+        jobs.enqueue(tasks.TASK_CHECK_MEMBERSHIP, request_data['api_url'])
     d = {
         'status': 'ok',
         'data': request_data
     }
-    # pp.pprint(request_data)
-    log.debug(u"request_id={} d: {}".format(request_id, json.dumps(d)))
     return jsonify(**d)
 
 
@@ -155,13 +206,11 @@ def web_hook_eventbrite():
 def web_hook_mailchimp():
     """ Web hook for incoming MailChimp changes.
     """
-    request_id = log_request()
     request_data = request.get_json()
     d = {
         'status': 'ok',
         'data': request_data
     }
-    log.debug(u"request_id={} d: {}".format(request_id, json.dumps(d)))
     return jsonify(**d)
 
 
@@ -169,11 +218,9 @@ def web_hook_mailchimp():
 def web_hook_typeform():
     """ Web hook for incoming Typeform changes.
     """
-    request_id = log_request()
     request_data = request.get_json()
     d = {
         'status': 'ok',
         'data': request_data
     }
-    log.debug(u"request_id={} d: {}".format(request_id, json.dumps(d)))
     return jsonify(**d)
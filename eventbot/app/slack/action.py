@@ -2,8 +2,11 @@
 
 from eventbot import settings
 from eventbot.app.mailchimp.api_client import MailChimpClient, MailChimpInterestManager
+from eventbot.app.eventbrite import attendee_store
 from eventbot.app.eventbrite.api_client import EventbriteClient
+from eventbot.app.slack import api_client as slack
 import logging
+import operator
 import pprint
 import simplejson as json
 import urllib
@@ -14,8 +17,6 @@ log = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(indent=4)
 
 
-# TODO Make it exclude refunded tickets and other 'not attending' people.
-# TODO Dynamically select the event ID based on date.
 def parse_attendees_command(user_name, event_id):
     """
     Returns a list of attendees, sorted by ticket class.
@@ -26,24 +27,60 @@ def parse_attendees_command(user_name, event_id):
     event_id = event_id.strip()
     eb_client = EventbriteClient(settings.EVENTBRITE_OAUTH_TOKEN, use_cache=settings.USE_CACHE)
     if event_id == '':
-        event_id = eb_client.get_event_snippets()[0]['id']
-    attendee_data = eb_client.get_event_attendees(event_id)
-    log.debug(json.dumps(attendee_data[0], indent=2))
-    attendee_data_filtered = [x for x in attendee_data if x['refunded'] is False]
-    attendee_data_by_ticket_type = sorted(attendee_data_filtered, key=lambda k: k['ticket_class_name'])
+        event = eb_client.get_next_event()
+        if event is None:
+            return 'There are no upcoming events, {}.'.format(user_name)
+        event_id = event['id']
+    store = attendee_store.get_store()
+    store.sync(eb_client, event_id)
+    attendee_data = store.iter_attendees(event_id)
+    attendee_data_by_ticket_type = sorted(
+        (x for x in attendee_data if x.is_attending()),
+        key=operator.attrgetter('ticket_class_name')
+    )
     lines = [
         '{}\t{}\t{}\t{}\t{}'.format(
             i+1,
-            x['ticket_class_name'].ljust(20),
-            x['profile']['name'].ljust(30),
-            x['profile']['email'].ljust(40),
-            str(x['refunded']).lower()
+            x.ticket_class_name.ljust(20),
+            x.name.ljust(30),
+            x.email.ljust(40),
+            str(x.refunded).lower()
         ) for i, x in enumerate(attendee_data_by_ticket_type)
     ]
     slack_message = 'Attendee list for {}: \n{}'.format(user_name, '\n'.join(lines))
     return slack_message
 
 
+def post_attendees_command(user_name, event_id, response_url):
+    """
+    Build the attendee list and post it to a slash command's response_url, in as many messages as it takes.
+    :param user_name: the user name of the Slack user who initiated the command
+    :param event_id: the ID of the event, or '' for the next event
+    :param response_url: the response_url Slack sent with the command
+    :return: the number of messages posted
+    """
+    # Failures are reported rather than raised: a retried job would post its apology, or the parts already
+    # sent, again, and Slack allows only a few posts to a response_url.
+    try:
+        message = parse_attendees_command(user_name, event_id)
+    except Exception as e:
+        log.exception("Could not build the attendee list for event_id='{}'".format(event_id))
+        try:
+            slack.post_to_response_url(
+                response_url,
+                'Sorry {}, I could not get the attendee list ({}).'.format(user_name, e)
+            )
+        except Exception:
+            log.exception("Could not post the apology to the response_url")
+            return 0
+        return 1
+    try:
+        return slack.post_message_in_parts(response_url, message)
+    except Exception:
+        log.exception("Could not post the attendee list for event_id='{}'".format(event_id))
+        return 0
+
+
 def parse_slash_command(command, user_name, text, request_data):
     """
     Process a slash command message from Slack.
@@ -62,18 +99,43 @@ def parse_slash_command(command, user_name, text, request_data):
     return message
 
 
-def parse_post(body):
-    """ Parse a POST request from Slack.
+def parse_payload(body):
+    """ Parse the payload of a POST request from Slack.
     """
     payload = json.loads(urllib.unquote(body.split('=')[1]))
     log.debug(u"Payload: {}".format(json.dumps(payload)))
-    resp = _approve_socialite(email_address=payload['callback_id'])
-    obj = {
-        'payload': payload,
-        'unencoded_payload': payload,
-        'mailchimp_response': resp
-    }
-    return obj
+    return payload
+
+
+def finish_approval(email_address, user_name, original_message_text, response_url):
+    """ Approve a socialite and replace the original message with the outcome.
+    """
+    try:
+        _approve_socialite(email_address=email_address)
+    except Exception as e:
+        # Report the failure rather than retrying, so that someone can simply press the button again.
+        log.exception(u"{} could not approve {}".format(user_name, email_address))
+        status = u"*Approval by {} failed: {}*".format(user_name, e)
+    else:
+        log.info(u"{} successfully approved {}".format(user_name, email_address))
+        status = u"*Successful approval by {}.*".format(user_name)
+    slack.post_to_response_url(
+        response_url,
+        format_approval_message(original_message_text, status),
+        response_type=None,
+        replace_original=True
+    )
+
+
+def format_approval_message(original_message_text, status):
+    return u"""
+{}
+
+{}
+""".format(
+        urllib.unquote_plus(original_message_text),
+        status
+    )
 
 
 def _approve_socialite(email_address):
@@ -84,6 +146,6 @@ def _approve_socialite(email_address):
         settings.MAILCHIMP_DEFAULT_LIST,
         settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY
     )
-    member = manager.get_member(email_address=email_address)
-    resp = manager.add_interest(member['id'], settings.MAILCHIMP_INTEREST_NAME_SOCIALITE)
+    member = manager.get_member(email_address=email_address, fields=['id'])
+    resp = manager.set_interests(member['id'], {settings.MAILCHIMP_INTEREST_NAME_SOCIALITE: True})
     return resp
@@ -1,11 +1,17 @@
 import logging
-import requests
 import simplejson as json
 
 from eventbot import settings
+from eventbot.integrations import transport
 
 log = logging.getLogger(__name__)
 
+# Slack advises keeping messages to a few thousand characters and truncates them at 40,000.
+MESSAGE_MAX_LENGTH = 4000
+MESSAGE_HARD_MAX_LENGTH = 40000
+# A response_url accepts up to five responses.
+RESPONSE_URL_MAX_POSTS = 5
+
 
 # TODO Deal with non-200s from Slack
 def post_form_to_webhook(form):
@@ -46,15 +52,71 @@ def post_form_to_webhook(form):
         ]
     }
     slack_webhook_url = settings.SLACK_WEBHOOK_URL
-    requests.post(slack_webhook_url, data=json.dumps(slack_webhook_obj))
+    transport.post(slack_webhook_url, data=json.dumps(slack_webhook_obj))
 
 
 def post_warning_to_webhook(message):
     """ Post a warning into Slack.
     """
     text = u"""
-    Warning! {message}
-    """.format(**message)
+    Warning! {}
+    """.format(message)
     slack_webhook_obj = {"text": text}
     slack_webhook_url = settings.SLACK_WEBHOOK_URL
-    requests.post(slack_webhook_url, data=json.dumps(slack_webhook_obj))
+    transport.post(slack_webhook_url, data=json.dumps(slack_webhook_obj))
+
+
+def post_to_response_url(response_url, text, response_type='ephemeral', replace_original=None):
+    """ Post a message to a slash command's or interactive message's response_url.
+
+    :param response_type: 'ephemeral' or 'in_channel', or None to keep an interactive message's own
+    :param replace_original: whether an interactive message should be replaced, or None to leave it to Slack
+    """
+    message = {'text': text}
+    if response_type is not None:
+        message['response_type'] = response_type
+    if replace_original is not None:
+        message['replace_original'] = replace_original
+    resp = transport.post(
+        response_url,
+        data=json.dumps(message),
+        headers={'Content-Type': 'application/json'}
+    )
+    if resp.status_code != 200:
+        log.warn("Slack response_url returned {}: {}".format(resp.status_code, resp.text))
+    return resp
+
+
+def post_message_in_parts(response_url, text, response_type='ephemeral'):
+    """ Post a long message to a response_url as several messages, each within Slack's size limits.
+    """
+    max_length = max(MESSAGE_MAX_LENGTH, -(-len(text) // RESPONSE_URL_MAX_POSTS))
+    parts = split_message(text, min(max_length, MESSAGE_HARD_MAX_LENGTH))
+    if len(parts) > RESPONSE_URL_MAX_POSTS:
+        omitted = sum(part.count('\n') + 1 for part in parts[RESPONSE_URL_MAX_POSTS - 1:])
+        parts = parts[:RESPONSE_URL_MAX_POSTS - 1] + ['...and {} more line(s) not shown.'.format(omitted)]
+    for part in parts:
+        post_to_response_url(response_url, part, response_type=response_type)
+    return len(parts)
+
+
+def split_message(text, max_length=MESSAGE_MAX_LENGTH):
+    """ Split text into parts of at most max_length characters, breaking between lines where possible.
+    """
+    parts = []
+    lines = []
+    length = 0
+    for line in text.split('\n'):
+        while len(line) > max_length:
+            line, rest = line[:max_length], line[max_length:]
+            if lines:
+                parts.append('\n'.join(lines))
+            parts.append(line)
+            lines, length, line = [], 0, rest
+        if lines and length + 1 + len(line) > max_length:
+            parts.append('\n'.join(lines))
+            lines, length = [], 0
+        length += len(line) + (1 if lines else 0)
+        lines.append(line)
+    parts.append('\n'.join(lines))
+    return parts
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+""" Background jobs enqueued by the web hooks.
+"""
+import logging
+
+from eventbot.app import attendee_reporter
+from eventbot.app.forms import ApplicationForm
+from eventbot.app.slack import action as slack_action
+from eventbot.app.slack import api_client as slack
+from eventbot.integrations import jobs
+
+log = logging.getLogger(__name__)
+
+TASK_POST_APPLICATION_FORM = 'post_application_form'
+TASK_CHECK_MEMBERSHIP = 'check_membership'
+TASK_POST_ATTENDEES = 'post_attendees'
+TASK_APPROVE_SOCIALITE = 'approve_socialite'
+
+
+@jobs.task(TASK_POST_APPLICATION_FORM)
+def post_application_form(data):
+    """ Post an application form, given as a dict of its fields, to Slack.
+    """
+    slack.post_form_to_webhook(ApplicationForm(data=data))
+
+
+@jobs.task(TASK_CHECK_MEMBERSHIP)
+def check_membership(eb_attendee_url):
+    attendee_reporter.check_membership(eb_attendee_url)
+
+
+@jobs.task(TASK_POST_ATTENDEES)
+def post_attendees(user_name, event_id, response_url):
+    slack_action.post_attendees_command(user_name, event_id, response_url)
+
+
+@jobs.task(TASK_APPROVE_SOCIALITE)
+def approve_socialite(email_address, user_name, original_message_text, response_url):
+    slack_action.finish_approval(email_address, user_name, original_message_text, response_url)
@@ -0,0 +1,351 @@
+import collections
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib
+
+import eventbot.integrations.defaults
+import eventbot.settings
+
+log = logging.getLogger(__name__)
+
+_caches = {}
+_cache_options = {}
+_caches_lock = threading.Lock()
+
+
+class ResponseCache:
+
+    """ Bounded cache of response bodies, scoped to the clients that use it.
+
+    Entries live in an in-memory LRU tier and, when `disk_path` is set, in an SQLite tier
+    that survives restarts. Both tiers are bounded in bytes. An entry is fresh for its TTL;
+    for `stale_timeout` seconds afterwards it is still served while a background thread
+    fetches a replacement. Entries may carry an ETag so that expired entries can be
+    revalidated with a conditional request instead of downloaded again.
+    """
+
+    name = ''
+    max_entries = 0
+    max_bytes = 0
+    default_ttl = 0
+    stale_timeout = 0
+
+    def __init__(
+            self,
+            name,
+            max_entries=eventbot.integrations.defaults.RESPONSE_CACHE_MAX_ENTRIES,
+            max_bytes=eventbot.integrations.defaults.RESPONSE_CACHE_MAX_BYTES,
+            default_ttl=eventbot.integrations.defaults.REQUESTS_CACHE_TIMEOUT,
+            ttls=None,
+            stale_timeout=eventbot.integrations.defaults.RESPONSE_CACHE_STALE_TIMEOUT,
+            disk_path=None,
+            disk_max_bytes=eventbot.integrations.defaults.RESPONSE_CACHE_DISK_MAX_BYTES,
+    ):
+        """
+
+        :param name: basestring
+        :param max_entries: maximum number of entries in the memory tier
+        :param max_bytes: maximum total size of the entries in the memory tier
+        :param default_ttl: number of seconds an entry is fresh, unless `ttls` says otherwise
+        :param ttls: list of (regular expression, seconds) pairs matched against the key
+        :param stale_timeout: number of seconds a stale entry may be served while it is refreshed
+        :param disk_path: path of the SQLite file for the disk tier, or None for memory only
+        :param disk_max_bytes: maximum total size of the entries in the disk tier
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in (ttls or [])]
+        self.stale_timeout = stale_timeout
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._revalidating = set()
+        self._lock = threading.RLock()
+        self._stats = collections.Counter()
+        self._db = None
+        if disk_path is not None:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, value TEXT, stored_at REAL, size INTEGER, accessed_at REAL, etag TEXT)'
+            )
+            self._db.commit()
+
+    def ttl_for(self, key, default_ttl=None):
+        """ Get the TTL for a key from `ttls`, falling back to `default_ttl`, or the cache's default_ttl.
+        """
+        for pattern, ttl in self.ttls:
+            if pattern.search(key):
+                return ttl
+        return default_ttl if default_ttl is not None else self.default_ttl
+
+    def get_or_fetch(self, key, fetch, ttl=None, conditional=False):
+        """
+        Return the cached value for the key, calling `fetch` to fill the cache if necessary.
+        :param key: basestring
+        :param fetch: function returning the value to cache, as a string. When `conditional` is
+            set, it is called with the cached ETag (or None) and returns a (value, etag) pair,
+            where a value of None means the cached value is still current.
+        :param ttl: number of seconds the value is fresh, or None to use `ttl_for(key)`
+        :param conditional: boolean
+        :return: basestring
+        """
+        if ttl is None:
+            ttl = self.ttl_for(key)
+        entry = self._lookup(key)
+        if entry is not None:
+            value, stored_at, _ = entry
+            age = time.time() - stored_at
+            if age < ttl:
+                self._stats['hits'] += 1
+                return value
+            if age < ttl + self.stale_timeout:
+                self._stats['stale_hits'] += 1
+                self._revalidate(key, fetch, conditional)
+                return value
+        self._stats['misses'] += 1
+        return self._fetch(key, fetch, entry, conditional)
+
+    def revalidate(self, key, fetch):
+        """ Fetch the value with a conditional request, whatever the age of the cached entry.
+
+        Only an existing entry is refreshed: a key that is not cached is fetched but not stored.
+        :param fetch: function called with the cached ETag (or None), as for a conditional get_or_fetch
+        """
+        entry = self._lookup(key)
+        if entry is None:
+            self._stats['misses'] += 1
+            value, _ = fetch(None)
+            return value
+        return self._fetch(key, fetch, entry, True)
+
+    def set(self, key, value, stored_at=None, etag=None):
+        if stored_at is None:
+            stored_at = time.time()
+        size = _size(value)
+        with self._lock:
+            self._store_memory(key, value, stored_at, etag)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, value, stored_at, size, stored_at, etag)
+                )
+                self._evict_disk()
+                self._db.commit()
+
+    def invalidate(self, key=None):
+        """ Drop one entry, or every entry when no key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif key in self._entries:
+                self._bytes -= _size(self._entries.pop(key)[0])
+            if self._db is not None:
+                if key is None:
+                    self._db.execute('DELETE FROM entries')
+                else:
+                    self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self._db.commit()
+
+    def invalidate_prefix(self, prefix):
+        """ Drop every entry whose key starts with the prefix.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._bytes -= _size(self._entries.pop(key)[0])
+            if self._db is not None:
+                self._db.execute('DELETE FROM entries WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            o = {
+                'hits': self._stats['hits'],
+                'stale_hits': self._stats['stale_hits'],
+                'disk_hits': self._stats['disk_hits'],
+                'misses': self._stats['misses'],
+                'not_modified': self._stats['not_modified'],
+                'evictions': self._stats['evictions'],
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+        return o
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Move to the most recently used end.
+                del self._entries[key]
+                self._entries[key] = entry
+                return entry
+            if self._db is None:
+                return None
+            row = self._db.execute('SELECT value, stored_at, etag FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._stats['disk_hits'] += 1
+            self._db.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self._db.commit()
+            self._store_memory(key, row[0], row[1], row[2])
+            return row[0], row[1], row[2]
+
+    def _fetch(self, key, fetch, entry, conditional):
+        if not conditional:
+            value = fetch()
+            self.set(key, value)
+            return value
+        etag = entry[2] if entry is not None else None
+        value, new_etag = fetch(etag)
+        if value is None:
+            self._stats['not_modified'] += 1
+            value, new_etag = entry[0], etag
+        self.set(key, value, etag=new_etag)
+        return value
+
+    def _store_memory(self, key, value, stored_at, etag=None):
+        if key in self._entries:
+            self._bytes -= _size(self._entries.pop(key)[0])
+        size = _size(value)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, stored_at, etag)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (evicted_value, _, _) = self._entries.popitem(last=False)
+            self._bytes -= _size(evicted_value)
+            self._stats['evictions'] += 1
+
+    def _evict_disk(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.disk_max_bytes:
+            return
+        rows = self._db.execute('SELECT key, size FROM entries ORDER BY accessed_at').fetchall()
+        for key, size in rows:
+            if total <= self.disk_max_bytes:
+                break
+            self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+            self._stats['evictions'] += 1
+
+    def _revalidate(self, key, fetch, conditional):
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def run():
+            try:
+                self._fetch(key, fetch, self._lookup(key), conditional)
+            except Exception as e:
+                log.warn("Cache {}: could not revalidate {} ({})".format(self.name, key, e))
+            finally:
+                with self._lock:
+                    self._revalidating.discard(key)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+class ExpiringSet:
+
+    """ Bounded set whose members expire `ttl` seconds after they were added.
+    """
+
+    ttl = 0
+    max_entries = 0
+
+    def __init__(self, ttl, max_entries=eventbot.integrations.defaults.RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.time() + self.ttl
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= time.time():
+                del self._entries[key]
+                return False
+            return True
+
+    def __len__(self):
+        with self._lock:
+            # Entries share one TTL, so they expire in the order they were added.
+            now = time.time()
+            while self._entries and next(iter(self._entries.values())) <= now:
+                self._entries.popitem(last=False)
+            return len(self._entries)
+
+
+def _size(value):
+    """ Get the size of a value in bytes, counting text as UTF-8.
+    """
+    if isinstance(value, unicode):
+        return len(value.encode('utf-8'))
+    return len(value)
+
+
+def build_key(url, params=None):
+    """ Build a cache key from a URL and its query parameters.
+    """
+    if not params:
+        return url
+    return '{}?{}'.format(url, urllib.urlencode(sorted(params.items())))
+
+
+def get_cache(name, **kwargs):
+    """ Return the process-wide cache with the specified name, creating it if necessary.
+
+    Keyword arguments configure the cache when it is created; asking for an existing cache with
+    different ones raises a ValueError, since they would otherwise be ignored. Settings that vary
+    between clients, such as TTLs, should be passed per call instead. If settings.RESPONSE_CACHE_DIR
+    is set, the cache also gets a disk tier in that directory.
+    """
+    with _caches_lock:
+        response_cache = _caches.get(name)
+        if response_cache is not None and _cache_options[name] != kwargs:
+            raise ValueError("Cache {} already exists with options {}".format(name, _cache_options[name]))
+        if response_cache is None:
+            _cache_options[name] = dict(kwargs)
+            cache_dir = eventbot.settings.RESPONSE_CACHE_DIR
+            if cache_dir and 'disk_path' not in kwargs:
+                kwargs['disk_path'] = os.path.join(cache_dir, '{}.sqlite'.format(name))
+            response_cache = ResponseCache(name, **kwargs)
+            _caches[name] = response_cache
+    return response_cache
+
+
+def invalidate_all():
+    """ Invalidate every cache in the process.
+    """
+    with _caches_lock:
+        for response_cache in _caches.values():
+            response_cache.invalidate()
+
@@ -0,0 +1,98 @@
+import collections
+import logging
+import sqlite3
+import threading
+import time
+
+import eventbot.integrations.defaults
+
+log = logging.getLogger(__name__)
+
+
+class DedupStore:
+
+    """ Responses to webhook deliveries, keyed by delivery, so that a redelivery can be answered again.
+
+    The most recent deliveries are kept in a bounded in-memory window in front of an SQLite table.
+    Entries expire `ttl` seconds after they were stored.
+    """
+
+    path = ''
+    ttl = 0
+    window = 0
+
+    def __init__(
+            self,
+            path=':memory:',
+            ttl=eventbot.integrations.defaults.WEBHOOK_DEDUP_TIMEOUT,
+            window=eventbot.integrations.defaults.WEBHOOK_DEDUP_WINDOW
+    ):
+        """
+
+        :param path: path of the SQLite file, or ':memory:' for a store that lasts as long as the process
+        :param ttl: number of seconds a delivery is remembered
+        :param window: maximum number of deliveries kept in memory
+        """
+        self.path = path
+        self.ttl = ttl
+        self.window = window
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS deliveries '
+            '(key TEXT PRIMARY KEY, status INTEGER, mimetype TEXT, body BLOB, expires_at REAL)'
+        )
+        self._db.execute('DELETE FROM deliveries WHERE expires_at <= ?', (time.time(),))
+        self._db.commit()
+
+    def get(self, key):
+        """ Get the stored response to a delivery as a (status, mimetype, body) tuple, or None if it is not known.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is None:
+                row = self._db.execute(
+                    'SELECT status, mimetype, body, expires_at FROM deliveries WHERE key = ?',
+                    (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                entry = (row[3], (row[0], row[1], str(row[2])))
+            expires_at, response = entry
+            if expires_at <= now:
+                self._db.execute('DELETE FROM deliveries WHERE key = ?', (key,))
+                self._db.commit()
+                return None
+            self._remember(key, entry)
+        return response
+
+    def put(self, key, status, mimetype, body):
+        """ Store the response to a delivery.
+        """
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, (expires_at, (status, mimetype, body)))
+            self._db.execute(
+                'INSERT OR REPLACE INTO deliveries VALUES (?, ?, ?, ?, ?)',
+                (key, status, mimetype, sqlite3.Binary(body), expires_at)
+            )
+            self._db.commit()
+
+    def invalidate(self, key=None):
+        """ Forget one delivery, or every delivery when no key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._memory.clear()
+                self._db.execute('DELETE FROM deliveries')
+            else:
+                self._memory.pop(key, None)
+                self._db.execute('DELETE FROM deliveries WHERE key = ?', (key,))
+            self._db.commit()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        while len(self._memory) > self.window:
+            self._memory.popitem(last=False)
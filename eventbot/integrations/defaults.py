@@ -1 +1,29 @@
 REQUESTS_CACHE_TIMEOUT = 300
+METADATA_REGISTRY_TIMEOUT = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+RESPONSE_CACHE_DISK_MAX_BYTES = 128 * 1024 * 1024
+RESPONSE_CACHE_STALE_TIMEOUT = 60
+NOT_FOUND_CACHE_TIMEOUT = 600
+MAILCHIMP_MAX_CONNECTIONS = 10
+MAILCHIMP_CHECKS_PER_SECOND = 10
+HTTP_POOL_SIZE = 10
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 30
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+EVENTBRITE_BATCH_SIZE = 50
+EVENTBRITE_BATCH_CONCURRENCY = 4
+EVENTBRITE_PAGE_RETRIES = 2
+EVENTBRITE_SNIPPETS_CACHE_TIMEOUT = 60
+JOB_QUEUE_WORKERS = 4
+JOB_QUEUE_MAX_ATTEMPTS = 5
+JOB_QUEUE_BACKOFF = 2
+JOB_QUEUE_POLL_INTERVAL = 1
+JOB_QUEUE_LEASE_TIMEOUT = 10 * 60
+WEBHOOK_DEDUP_TIMEOUT = 24 * 60 * 60
+WEBHOOK_DEDUP_WINDOW = 1000
+REQUEST_LOG_SAMPLE_RATE = 1.0
+REQUEST_LOG_BODY_MAX_LENGTH = 1000
+REQUEST_LOG_REDACTED_FIELDS = ('token', 'code', 'client_secret', 'password', 'apikey', 'api_key')
+REQUEST_LOG_REDACTED_HEADERS = ('Authorization', 'Cookie', 'X-Slack-Signature')
@@ -0,0 +1,380 @@
+import collections
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+import simplejson
+
+import eventbot.integrations.defaults
+import eventbot.settings
+
+log = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+
+_handlers = {}
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+class UnknownTaskException(Exception):
+    pass
+
+
+class JobQueue:
+
+    """ Durable queue of background jobs, run by a pool of worker threads in this process.
+
+    Jobs are stored in SQLite until they succeed. A failed job is retried with exponential
+    backoff; after `max_attempts` failures it is moved to the dead-letter table, where it can
+    be inspected and requeued. Several processes can share a queue file: a job is claimed in a
+    single write transaction and leased to its claimant for `lease_timeout` seconds, after which
+    a job whose process died is run again by whichever worker claims it next.
+    In eager mode, `enqueue` runs the job (and its retries, without waiting) before returning,
+    which is what the tests use.
+    """
+
+    path = ''
+    workers = 0
+    max_attempts = 0
+    backoff = 0
+    lease_timeout = 0
+    eager = False
+    owner = ''
+
+    def __init__(
+            self,
+            path=':memory:',
+            workers=eventbot.integrations.defaults.JOB_QUEUE_WORKERS,
+            max_attempts=eventbot.integrations.defaults.JOB_QUEUE_MAX_ATTEMPTS,
+            backoff=eventbot.integrations.defaults.JOB_QUEUE_BACKOFF,
+            poll_interval=eventbot.integrations.defaults.JOB_QUEUE_POLL_INTERVAL,
+            lease_timeout=eventbot.integrations.defaults.JOB_QUEUE_LEASE_TIMEOUT,
+            eager=False
+    ):
+        """
+
+        :param path: path of the SQLite file, or ':memory:' for a queue that lasts as long as the process
+        :param workers: number of worker threads
+        :param max_attempts: number of times a job is tried before it is dead-lettered
+        :param backoff: number of seconds before the first retry; doubled for each further retry
+        :param poll_interval: maximum number of seconds an idle worker waits before checking for due jobs
+        :param lease_timeout: number of seconds a running job belongs to its worker; it should be longer
+            than any job takes
+        :param eager: whether to run jobs in the enqueuing thread instead of on the workers
+        """
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.lease_timeout = lease_timeout
+        self.eager = eager
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), id(self))
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._threads = []
+        self._stopping = False
+        self._stats = collections.Counter()
+        # Transactions are begun explicitly (see _transaction), so that claims can take the write lock up front.
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._transaction():
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs '
+                '(id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT, payload TEXT, status TEXT, '
+                'attempts INTEGER, run_at REAL, enqueued_at REAL, last_error TEXT, owner TEXT, '
+                'lease_expires_at REAL, unique_key TEXT)'
+            )
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(jobs)').fetchall()]
+            for column, column_type in [('owner', 'TEXT'), ('lease_expires_at', 'REAL'), ('unique_key', 'TEXT')]:
+                if column not in columns:
+                    self._db.execute('ALTER TABLE jobs ADD COLUMN {} {}'.format(column, column_type))
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS dead_letters '
+                '(id INTEGER PRIMARY KEY, task TEXT, payload TEXT, attempts INTEGER, enqueued_at REAL, '
+                'failed_at REAL, last_error TEXT)'
+            )
+            # Only jobs whose lease has run out are recovered: others may still be running in another process.
+            self._db.execute(
+                'UPDATE jobs SET status = ?, owner = NULL '
+                'WHERE status = ? AND (lease_expires_at IS NULL OR lease_expires_at <= ?)',
+                (STATUS_QUEUED, STATUS_RUNNING, time.time())
+            )
+
+    def enqueue(self, task_name, *args, **kwargs):
+        """
+        Add a job to the queue, returning its ID.
+        :param task_name: name the handler was registered under with `task`
+        :param args: JSON-serialisable positional arguments for the handler
+        :param kwargs: JSON-serialisable keyword arguments for the handler
+        """
+        return self._add(task_name, None, args, kwargs)
+
+    def enqueue_unique(self, task_name, unique_key, *args, **kwargs):
+        """
+        Add a job to the queue unless a job for the same task and key is already queued or running,
+        returning its ID, or None if there was one. The key is released when the job succeeds or is
+        dead-lettered, in whichever process shares the queue file.
+        :param task_name: name the handler was registered under with `task`
+        :param unique_key: key identifying the job among the task's jobs
+        :param args: JSON-serialisable positional arguments for the handler
+        :param kwargs: JSON-serialisable keyword arguments for the handler
+        """
+        return self._add(task_name, unique_key, args, kwargs)
+
+    def _add(self, task_name, unique_key, args, kwargs):
+        if task_name not in _handlers:
+            raise UnknownTaskException("No handler registered for task {}".format(task_name))
+        payload = simplejson.dumps({'args': args, 'kwargs': kwargs})
+        now = time.time()
+        with self._transaction():
+            if unique_key is not None and self._db.execute(
+                    'SELECT 1 FROM jobs WHERE task = ? AND unique_key = ?',
+                    (task_name, unique_key)
+            ).fetchone():
+                log.debug("Job task={} key={} is already queued".format(task_name, unique_key))
+                return None
+            cursor = self._db.execute(
+                'INSERT INTO jobs (task, payload, status, attempts, run_at, enqueued_at, unique_key) '
+                'VALUES (?, ?, ?, 0, ?, ?, ?)',
+                (task_name, payload, STATUS_QUEUED, now, now, unique_key)
+            )
+            job_id = cursor.lastrowid
+            self._stats['enqueued'] += 1
+            self._wakeup.notify()
+        log.debug("Enqueued job id={} task={}".format(job_id, task_name))
+        if self.eager:
+            while self._run_next(job_id, ignore_backoff=True):
+                pass
+        else:
+            self.start()
+        return job_id
+
+    def start(self):
+        """ Start the worker threads, if they are not already running.
+        """
+        with self._lock:
+            if self._threads or self.eager:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name='job-worker-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """ Ask the worker threads to finish their current job and exit.
+        """
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+
+    def run_pending(self):
+        """ Run every job that is due in the calling thread, returning the number of jobs run.
+        """
+        count = 0
+        while self._run_next():
+            count += 1
+        return count
+
+    def stats(self):
+        """ Return queue depth and job counters.
+        """
+        with self._lock:
+            depth = dict(self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            dead = self._db.execute('SELECT COUNT(*) FROM dead_letters').fetchone()[0]
+            oldest = self._db.execute('SELECT MIN(enqueued_at) FROM jobs').fetchone()[0]
+            return {
+                'queued': depth.get(STATUS_QUEUED, 0),
+                'running': depth.get(STATUS_RUNNING, 0),
+                'dead': dead,
+                'oldest_age': time.time() - oldest if oldest is not None else 0,
+                'enqueued': self._stats['enqueued'],
+                'succeeded': self._stats['succeeded'],
+                'retried': self._stats['retried'],
+                'dead_lettered': self._stats['dead_lettered'],
+            }
+
+    def dead_letters(self):
+        """ Return the dead-lettered jobs, oldest first.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, task, payload, attempts, failed_at, last_error FROM dead_letters ORDER BY failed_at'
+            ).fetchall()
+        return [
+            {
+                'id': r[0],
+                'task': r[1],
+                'payload': simplejson.loads(r[2]),
+                'attempts': r[3],
+                'failed_at': r[4],
+                'last_error': r[5],
+            } for r in rows
+        ]
+
+    def requeue(self, job_id):
+        """ Move a dead-lettered job back onto the queue, with its attempts reset.
+        """
+        with self._transaction():
+            row = self._db.execute(
+                'SELECT task, payload, enqueued_at FROM dead_letters WHERE id = ?',
+                (job_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            self._db.execute(
+                'INSERT INTO jobs (id, task, payload, status, attempts, run_at, enqueued_at) '
+                'VALUES (?, ?, ?, ?, 0, ?, ?)',
+                (job_id, row[0], row[1], STATUS_QUEUED, time.time(), row[2])
+            )
+            self._db.execute('DELETE FROM dead_letters WHERE id = ?', (job_id,))
+            self._wakeup.notify()
+        return True
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if self._stopping:
+                    return
+            if not self._run_next():
+                with self._lock:
+                    if self._stopping:
+                        return
+                    self._wakeup.wait(self.poll_interval)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """ Run statements in one transaction that holds SQLite's write lock, and this queue's lock, throughout.
+        """
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _claim(self, job_id=None, ignore_backoff=False):
+        """ Lease a due job to this queue, returning its row, or None if there is none.
+
+        A running job whose lease has expired is claimed like a queued one.
+        """
+        now = time.time()
+        claimable = '(status = ? OR (status = ? AND lease_expires_at <= ?))'
+        with self._transaction():
+            query = 'SELECT id, task, payload, attempts FROM jobs WHERE ' + claimable
+            params = [STATUS_QUEUED, STATUS_RUNNING, now]
+            if job_id is not None:
+                query += ' AND id = ?'
+                params.append(job_id)
+            if not ignore_backoff:
+                query += ' AND run_at <= ?'
+                params.append(now)
+            row = self._db.execute(query + ' ORDER BY run_at LIMIT 1', params).fetchone()
+            if row is None:
+                return None
+            cursor = self._db.execute(
+                'UPDATE jobs SET status = ?, owner = ?, lease_expires_at = ? WHERE id = ? AND ' + claimable,
+                (STATUS_RUNNING, self.owner, now + self.lease_timeout, row[0], STATUS_QUEUED, STATUS_RUNNING, now)
+            )
+            if cursor.rowcount != 1:
+                return None
+        return row
+
+    def _run_next(self, job_id=None, ignore_backoff=False):
+        """ Run one due job, returning whether there was one.
+        """
+        row = self._claim(job_id, ignore_backoff)
+        if row is None:
+            return False
+        job_id, task_name, payload, attempts = row
+        data = simplejson.loads(payload)
+        try:
+            _handlers[task_name](*data['args'], **data['kwargs'])
+        except Exception as e:
+            self._fail(job_id, task_name, attempts + 1, '{}\n{}'.format(e, traceback.format_exc()))
+            return True
+        with self._transaction():
+            self._db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            self._stats['succeeded'] += 1
+        log.debug("Job id={} task={} succeeded".format(job_id, task_name))
+        return True
+
+    def _fail(self, job_id, task_name, attempts, error):
+        with self._transaction():
+            if attempts >= self.max_attempts:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO dead_letters '
+                    'SELECT id, task, payload, ?, enqueued_at, ?, ? FROM jobs WHERE id = ?',
+                    (attempts, time.time(), error, job_id)
+                )
+                self._db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+                self._stats['dead_lettered'] += 1
+                log.error("Job id={} task={} failed {} time(s), dead-lettered: {}".format(
+                    job_id,
+                    task_name,
+                    attempts,
+                    error
+                ))
+            else:
+                delay = self.backoff * 2 ** (attempts - 1)
+                self._db.execute(
+                    'UPDATE jobs SET status = ?, attempts = ?, run_at = ?, last_error = ?, owner = NULL WHERE id = ?',
+                    (STATUS_QUEUED, attempts, time.time() + delay, error, job_id)
+                )
+                self._stats['retried'] += 1
+                log.warn("Job id={} task={} failed (attempt {}), retrying in {}s".format(
+                    job_id,
+                    task_name,
+                    attempts,
+                    delay
+                ))
+
+
+def task(name):
+    """ Decorator registering a function as the handler for a task name.
+    """
+    def register(fn):
+        _handlers[name] = fn
+        return fn
+    return register
+
+
+def get_queue(name='default'):
+    """ Return the process-wide queue with the specified name, creating it if necessary.
+
+    The queue is stored in settings.JOB_QUEUE_DIR when that is set, and runs jobs eagerly
+    when settings.JOB_QUEUE_EAGER is set.
+    """
+    with _queues_lock:
+        queue = _queues.get(name)
+        if queue is None:
+            queue_dir = eventbot.settings.JOB_QUEUE_DIR
+            path = os.path.join(queue_dir, '{}.sqlite'.format(name)) if queue_dir else ':memory:'
+            queue = JobQueue(path, eager=eventbot.settings.JOB_QUEUE_EAGER)
+            _queues[name] = queue
+    return queue
+
+
+def enqueue(task_name, *args, **kwargs):
+    """ Add a job to the default queue.
+    """
+    return get_queue().enqueue(task_name, *args, **kwargs)
+
+
+def enqueue_unique(task_name, unique_key, *args, **kwargs):
+    """ Add a job to the default queue unless one with the same task and key is pending.
+    """
+    return get_queue().enqueue_unique(task_name, unique_key, *args, **kwargs)
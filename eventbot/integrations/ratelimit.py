@@ -0,0 +1,35 @@
+import threading
+import time
+
+
+class RateLimiter:
+
+    """ Token bucket shared between threads: `acquire` blocks until a call may go ahead.
+    """
+
+    rate = 0
+    burst = 0
+
+    def __init__(self, rate, burst=None):
+        """
+
+        :param rate: number of calls allowed per second
+        :param burst: number of calls allowed at once after an idle period; defaults to `rate`
+        """
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,109 @@
+import logging
+import threading
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import eventbot.integrations.defaults
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# POST is left out: a retried POST could, for example, submit a MailChimp batch twice.
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'PATCH', 'DELETE'])
+
+_options = {
+    'pool_size': eventbot.integrations.defaults.HTTP_POOL_SIZE,
+    'connect_timeout': eventbot.integrations.defaults.HTTP_CONNECT_TIMEOUT,
+    'read_timeout': eventbot.integrations.defaults.HTTP_READ_TIMEOUT,
+    'max_retries': eventbot.integrations.defaults.HTTP_MAX_RETRIES,
+    'backoff_factor': eventbot.integrations.defaults.HTTP_BACKOFF_FACTOR,
+}
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class TransportSession(requests.Session):
+
+    """ Keep-alive session for one upstream host, with default timeouts and retries.
+    """
+
+    timeout = None
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, max_retries, backoff_factor):
+        requests.Session.__init__(self)
+        self.timeout = (connect_timeout, read_timeout)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=build_retry(max_retries, backoff_factor)
+        )
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return requests.Session.request(self, method, url, **kwargs)
+
+
+def build_retry(max_retries, backoff_factor):
+    kwargs = {
+        'total': max_retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': RETRY_STATUSES,
+        'raise_on_status': False,
+    }
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+def configure(**options):
+    """ Change the pool size, timeouts or retry policy for sessions created from now on.
+
+    Accepts pool_size, connect_timeout, read_timeout, max_retries and backoff_factor.
+    Existing sessions are closed so the next request picks up the new options.
+    """
+    unknown = set(options) - set(_options)
+    if unknown:
+        raise ValueError("Unknown transport option/s: {}".format(', '.join(sorted(unknown))))
+    with _sessions_lock:
+        _options.update(options)
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_session(url):
+    """ Return the shared session for the URL's scheme and host, creating it if necessary.
+    """
+    parts = urlparse.urlsplit(url)
+    key = '{}://{}'.format(parts.scheme, parts.netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            log.debug("Creating session for {}".format(key))
+            session = TransportSession(**_options)
+            _sessions[key] = session
+    return session
+
+
+def request(method, url, **kwargs):
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return request('PATCH', url, **kwargs)
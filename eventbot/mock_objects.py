@@ -42,6 +42,7 @@ EVENTBRITE_MOCK_RESPONSE_ATTENDEES = {
     },
     "attendees": [
         {
+            "id": "1",
             "profile": {
                 "name": "Foo Bar",
                 "email": "foo@bar.com"
@@ -3,12 +3,16 @@
 import logging
 
 from app import app
+from eventbot.integrations import jobs
 
 import settings
 
 logging.basicConfig(format=settings.LOG_FORMAT, level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
+# Run the jobs left in the queue by a previous process without waiting for the next one to be enqueued.
+jobs.get_queue().start()
+
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
@@ -24,6 +24,25 @@ MAILCHIMP_DEFAULT_LIST = os.environ.get('MAILCHIMP_DEFAULT_LIST')
 MAILCHIMP_DEFAULT_EMAIL = os.environ.get('MAILCHIMP_DEFAULT_EMAIL', 'foo@bar.com')
 
 REQUESTS_CACHE_TIMEOUT = os.environ.get('REQUESTS_CACHE_TIMEOUT', 300)
+# Directory for the on-disk response cache tier; the cache is memory-only when unset.
+RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR')
+
+# SQLite file for the Eventbrite attendee store; the store is memory-only when unset.
+ATTENDEE_STORE_PATH = os.environ.get('ATTENDEE_STORE_PATH')
+
+# Directory for the background job queue's SQLite file; the queue is memory-only when unset.
+JOB_QUEUE_DIR = os.environ.get('JOB_QUEUE_DIR')
+# Run background jobs in the request thread, e.g. for tests.
+JOB_QUEUE_EAGER = strtobool(os.environ.get('JOB_QUEUE_EAGER', 'false'))
+
+# Directory for the SQLite file of webhook deliveries already answered; they are kept in memory when unset.
+WEBHOOK_DEDUP_DIR = os.environ.get('WEBHOOK_DEDUP_DIR')
+
+# Request logging: the level of the per-request line, the fraction of requests logged and the
+# number of body characters included (0 for none).
+REQUEST_LOG_LEVEL = os.environ.get('REQUEST_LOG_LEVEL', 'DEBUG')
+REQUEST_LOG_SAMPLE_RATE = float(os.environ.get('REQUEST_LOG_SAMPLE_RATE', 1.0))
+REQUEST_LOG_BODY_MAX_LENGTH = int(os.environ.get('REQUEST_LOG_BODY_MAX_LENGTH', 1000))
 
 SLACK_BOT_ID = os.environ.get('BOT_ID')
 SLACK_BOT_NAME = os.environ.get('SLACK_BOT_NAME')
@@ -1,19 +1,29 @@
 # coding=utf-8
 from __future__ import print_function
-from app import app, routes, mailchimp
+from app import app, routes, eventbrite, mailchimp, reconciliation, request_logging
+from app.eventbrite import attendee_store
+from integrations import cache, dedup, jobs, ratelimit, transport
+from flask import Flask
 from simplejson import JSONDecodeError
 import logging
 import mock_objects as mocks
+import requests
 import requests_mock
 import settings
 import simplejson as json
 import test_fixtures as fixtures
+import io
+import os
+import tarfile
+import tempfile
+import time
 import unittest
 import urllib
 
 logging.basicConfig(format=settings.LOG_FORMAT, level=logging.DEBUG)
 
 settings.USE_CACHE = False
+settings.JOB_QUEUE_EAGER = True
 
 
 @requests_mock.Mocker()
@@ -23,6 +33,9 @@ class ApiTestCase(unittest.TestCase):
 
     def setUp(self):
         self.app = app.test_client()
+        mailchimp.registry.invalidate_all()
+        attendee_store.invalidate_all()
+        app.extensions['dedup'].invalidate()
 
     def tearDown(self):
         pass
@@ -31,6 +44,43 @@ class ApiTestCase(unittest.TestCase):
     def test_webhook_application_form_success(self, m):
         m.register_uri('POST', url=settings.SLACK_WEBHOOK_URL, text='foo')
         self.post_form_to_webhook(path=routes.ROUTES_WEB_HOOK_APPLICATION_FORM, data=build_form_payload())
+        self.assertTrue(m.called)
+
+    def test_repeat_deliveries_are_answered_from_the_dedup_store(self, m):
+        m.register_uri('POST', url=settings.SLACK_WEBHOOK_URL, text='foo')
+        data = build_form_payload()
+        data['EntryId'] = '42'
+        first = self.post_form_to_webhook(path=routes.ROUTES_WEB_HOOK_APPLICATION_FORM, data=data)
+        call_count = m.call_count
+        second = self.post_form_to_webhook(path=routes.ROUTES_WEB_HOOK_APPLICATION_FORM, data=data)
+        self.assertEqual(first, second)
+        self.assertEqual(m.call_count, call_count)
+
+        data['EntryId'] = '43'
+        self.post_form_to_webhook(path=routes.ROUTES_WEB_HOOK_APPLICATION_FORM, data=data)
+        self.assertGreater(m.call_count, call_count)
+
+    def test_provider_delivery_ids_take_precedence_over_request_ids(self, m):
+        m.register_uri('POST', url=settings.SLACK_WEBHOOK_URL, text='foo')
+        data = build_form_payload()
+        data['EntryId'] = '44'
+        for request_id in ['r1', 'r2']:
+            resp = self.app.post(
+                routes.ROUTES_WEB_HOOK_APPLICATION_FORM,
+                data=data,
+                headers={'X-Request-ID': request_id}
+            )
+            self.assertEqual(resp.status_code, 200)
+        self.assertEqual(m.call_count, 1)
+
+    def test_dedup_store_window_falls_back_to_persistent_store(self, m):
+        store = dedup.DedupStore(ttl=60, window=1)
+        store.put('a', 200, 'text/plain', 'first')
+        store.put('b', 200, 'text/plain', 'second')
+        self.assertEqual(store.get('a'), (200, 'text/plain', 'first'))
+        store.ttl = 0
+        store.put('c', 200, 'text/plain', 'third')
+        self.assertIsNone(store.get('c'))
 
     # @unittest.SkipTest
     def test_webhook_eventbrite_success(self, m):
@@ -46,6 +96,30 @@ class ApiTestCase(unittest.TestCase):
         )
         assert o['data']['config']['action'] == 'order.placed', o
 
+    def test_webhook_eventbrite_attendee_updated_enqueues_membership_check(self, m):
+        calls = []
+        jobs.task(routes.tasks.TASK_CHECK_MEMBERSHIP)(calls.append)
+        try:
+            data = {'config': {'action': 'attendee.updated'}, 'api_url': 'https://www.eventbriteapi.com/v3/a/1/'}
+            self.post_to_endpoint(path=routes.ROUTES_WEB_HOOK_EVENTBRITE, data=data)
+        finally:
+            jobs.task(routes.tasks.TASK_CHECK_MEMBERSHIP)(routes.tasks.check_membership)
+        self.assertEqual(calls, [data['api_url']])
+
+    def test_check_membership_warns_about_unknown_attendees(self, m):
+        api_url = 'https://www.eventbriteapi.com/v3/events/1/attendees/1/'
+        attendee = dict(mocks.EVENTBRITE_MOCK_RESPONSE_ATTENDEES['attendees'][0], event_id='1')
+        m.register_uri('GET', url=api_url, json=attendee)
+        m.register_uri(
+            'GET',
+            url='{}/search-members'.format(mailchimp.api_client.BASE_URL),
+            json={'exact_matches': {'members': []}}
+        )
+        m.register_uri('POST', url=settings.SLACK_WEBHOOK_URL, text='ok')
+        routes.tasks.check_membership(api_url)
+        self.assertEqual(m.last_request.url, settings.SLACK_WEBHOOK_URL)
+        self.assertIn('is not in our database', m.last_request.json()['text'])
+
     # @unittest.SkipTest
     def test_webhook_mailchimp_success(self, m):
         data = {
@@ -91,17 +165,43 @@ class ApiTestCase(unittest.TestCase):
         m.register_uri(
             'PATCH',
             url='{}/False/members/foo'.format(lists_base_url),
-            text='{"status": "ok"}'
+            json=mocks.MAILCHIMP_MOCK_RESPONSE_MEMBER
         )
         m.register_uri(
             'GET',
             url='{}/False/members/{}'.format(lists_base_url, subscriber_hash),
             json=mocks.MAILCHIMP_MOCK_RESPONSE_MEMBER
         )
+        response_url = 'https://hooks.slack.com/actions/T2A1BQ1RU/170072243252/w5B4dWoLzIaAEjeCMoWDUKUL'
+        m.register_uri('POST', url=response_url, text='ok')
         data = fixtures.SLACK_ACTION_ENDPOINT_EXAMPLE_1
         data = data.replace('application_form_action', email)
         o = self.post_to_endpoint(path='/slack/action-endpoint', data=data, is_json_data=False, is_json_response=False)
-        assert "Successful approval" in o
+        assert "in progress" in o
+        assert m.last_request.url == response_url
+        assert "Successful approval" in m.last_request.json()['text']
+        assert m.last_request.json()['replace_original'] is True
+
+        # A second press while the approval is still queued is coalesced into the first.
+        app.extensions['dedup'].invalidate()
+        queue = jobs.get_queue()
+        eager, workers = queue.eager, queue.workers
+        queue.eager, queue.workers = False, 0
+        try:
+            self.post_to_endpoint(path='/slack/action-endpoint', data=data, is_json_data=False, is_json_response=False)
+            app.extensions['dedup'].invalidate()
+            request_count = len(m.request_history)
+            o = self.post_to_endpoint(
+                path='/slack/action-endpoint',
+                data=data,
+                is_json_data=False,
+                is_json_response=False
+            )
+            assert "already in progress" in o
+            assert len(m.request_history) == request_count
+        finally:
+            queue.eager, queue.workers = eager, workers
+            queue.run_pending()
 
     # @unittest.SkipTest
     def test_web_hook_slack_slash_command_attendees_success(self, m):
@@ -111,6 +211,7 @@ class ApiTestCase(unittest.TestCase):
             json=mocks.EVENTBRITE_MOCK_RESPONSE_ATTENDEES
         )
         data = fixtures.ROUTES_WEB_HOOK_SLACK_SLASH_COMMAND_ATTENDEES_EXAMPLE_1
+        m.register_uri('POST', url=data['response_url'], text='ok')
         path = routes.ROUTES_WEB_HOOK_SLACK_SLASH_COMMAND_ATTENDEES
         o = self.post_to_endpoint(
             path=path,
@@ -118,7 +219,44 @@ class ApiTestCase(unittest.TestCase):
             is_json_data=False,
             is_json_response=False
         )
-        self.assertIn('Attendee list for {}'.format(data['user_name']), o)
+        self.assertIn('Fetching the attendee list', o)
+        self.assertIn('Attendee list for {}'.format(data['user_name']), m.last_request.json()['text'])
+
+    def test_slash_command_attendees_failure_is_reported_once(self, m):
+        m.register_uri(
+            'GET',
+            url='https://www.eventbriteapi.com/v3/events/q/attendees/',
+            status_code=500,
+            json={'error': 'INTERNAL_ERROR'}
+        )
+        data = fixtures.ROUTES_WEB_HOOK_SLACK_SLASH_COMMAND_ATTENDEES_EXAMPLE_1
+        m.register_uri('POST', url=data['response_url'], text='ok')
+        dead_letter_count = len(jobs.get_queue().dead_letters())
+        self.post_to_endpoint(
+            path=routes.ROUTES_WEB_HOOK_SLACK_SLASH_COMMAND_ATTENDEES,
+            data=data,
+            is_json_data=False,
+            is_json_response=False
+        )
+        posts = [r for r in m.request_history if r.method == 'POST' and r.url == data['response_url']]
+        self.assertEqual(len(posts), 1)
+        self.assertIn('Sorry', posts[0].json()['text'])
+        self.assertEqual(len(jobs.get_queue().dead_letters()), dead_letter_count)
+
+    def test_long_slack_messages_are_split(self, m):
+        slack = routes.slack_action.slack
+        lines = ['{}\t{}'.format(i, 'x' * 90) for i in range(200)]
+        parts = slack.split_message('\n'.join(lines), max_length=1000)
+        self.assertTrue(all(len(p) <= 1000 for p in parts))
+        self.assertEqual('\n'.join(parts).split('\n'), lines)
+        m.register_uri('POST', url='https://hooks.slack.com/commands/x', text='ok')
+        self.assertEqual(slack.post_message_in_parts('https://hooks.slack.com/commands/x', '\n'.join(lines)), 5)
+        self.assertEqual(m.call_count, 5)
+        text = '\n'.join('y' * 999 for _ in range(250))
+        self.assertEqual(slack.post_message_in_parts('https://hooks.slack.com/commands/x', text), 5)
+        posts = m.request_history[5:]
+        self.assertTrue(all(len(r.json()['text']) <= slack.MESSAGE_HARD_MAX_LENGTH for r in posts))
+        self.assertIn('more line(s) not shown', m.last_request.json()['text'])
 
     def post_to_endpoint(self, path, data, is_json_data=True, is_json_response=True):
         if is_json_data:
@@ -147,6 +285,625 @@ class ApiTestCase(unittest.TestCase):
         return o
 
 
+class MailChimpTestCase(unittest.TestCase):
+
+    """ Mocks the MailChimp metadata and builds a client and an interest manager on it for each test.
+    """
+
+    def setUp(self):
+        mailchimp.registry.invalidate_all()
+        self.m = requests_mock.Mocker()
+        self.m.start()
+        self.addCleanup(self.m.stop)
+        self.lists_base_url = register_mailchimp_metadata(self.m)
+        self.mc = mailchimp.api_client.MailChimpClient('key', use_cache=False)
+        self.manager = mailchimp.api_client.MailChimpInterestManager(
+            self.mc,
+            'foo',
+            settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY
+        )
+
+
+class MailChimpMetadataRegistryTestCase(MailChimpTestCase):
+
+    def test_lookups_are_served_from_memory(self):
+        self.mc.registry.invalidate()
+        calls = self.m.call_count
+        misses = self.mc.registry.stats()['misses']
+        for _ in range(3):
+            interest_id = self.mc.lookup_interest_id('foo', settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY, 'Socialites')
+            self.assertEqual(interest_id, 'foo')
+        self.assertEqual(self.m.call_count - calls, 3)
+        self.assertEqual(self.mc.registry.stats()['misses'] - misses, 3)
+        self.mc.registry.invalidate()
+        self.mc.lookup_list_id('foo')
+        self.assertEqual(self.m.call_count - calls, 4)
+
+    def test_clients_sharing_a_registry_keep_their_own_settings(self):
+        calls = self.m.call_count
+        self.mc.lookup_list_id('foo')
+        self.assertEqual(self.m.call_count, calls)
+        fresh = mailchimp.api_client.MailChimpClient('key', use_cache=False, metadata_timeout=0)
+        self.assertIs(fresh.registry, self.mc.registry)
+        fresh.lookup_list_id('foo')
+        self.assertEqual(self.m.call_count - calls, 1)
+
+
+class MailChimpMemberMirrorTestCase(MailChimpTestCase):
+
+    def test_check_interest_is_answered_from_mirror(self):
+        members = [
+            {
+                'id': mailchimp.api_client.calculate_subscriber_hash(email),
+                'email_address': email,
+                'interests': {'foo': True}
+            }
+            for email in ['a@example.com', 'B@example.com']
+        ]
+        self.m.register_uri('GET', url='{}/bar/members'.format(self.lists_base_url), response_list=[
+            {'json': {'members': members[:1], 'total_items': 2}},
+            {'json': {'members': members[1:], 'total_items': 2}},
+        ])
+        mirror = mailchimp.mirror.MailChimpMemberMirror(self.mc, 'bar', page_size=1)
+        self.assertEqual(mirror.sync(), 2)
+        self.mc.attach_mirror(mirror)
+        category = settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY
+        self.assertTrue(self.mc.check_interest(' b@example.com', 'foo', category, 'Socialites'))
+        with self.assertRaises(mailchimp.api_client.NotFoundException):
+            self.mc.check_interest('c@example.com', 'foo', category, 'Socialites')
+        self.assertFalse(any('search-members' in r.url for r in self.m.request_history))
+
+        # A failed sync leaves the previous copy in place.
+        self.m.register_uri('GET', url='{}/bar/members'.format(self.lists_base_url), response_list=[
+            {'json': {'members': members[:1], 'total_items': 2}},
+            {'status_code': 400, 'json': {'detail': 'bad request'}},
+        ])
+        with self.assertRaises(requests.HTTPError):
+            mirror.sync(full=True)
+        self.assertEqual(len(mirror), 2)
+
+
+class MailChimpInterestManagerTestCase(MailChimpTestCase):
+
+    def test_bulk_update_interests(self):
+        results_url = 'https://example.com/batch-results.tar.gz'
+        self.m.register_uri('POST', url='{}/batches'.format(mailchimp.api_client.BASE_URL), json={'id': 'b1'})
+        self.m.register_uri('GET', url='{}/batches/b1'.format(mailchimp.api_client.BASE_URL), json={
+            'id': 'b1',
+            'status': 'finished',
+            'total_operations': 2,
+            'finished_operations': 2,
+            'errored_operations': 1,
+            'response_body_url': results_url
+        })
+        self.m.register_uri('GET', url=results_url, content=build_batch_results_archive([
+            {'status_code': 200, 'operation_id': 'm1', 'response': json.dumps(mocks.MAILCHIMP_MOCK_RESPONSE_MEMBER)},
+            {'status_code': 404, 'operation_id': 'm2', 'response': json.dumps({'detail': 'not found'})},
+        ]))
+        results = self.manager.bulk_update_interests(
+            {'m1': {'Socialites': True}, 'm2': {'Socialites': True}},
+            poll_interval=0
+        )
+        self.assertTrue(results['m1']['ok'])
+        self.assertFalse(results['m2']['ok'])
+        self.assertEqual(results['m2']['response']['detail'], 'not found')
+        operations = [r for r in self.m.request_history if r.method == 'POST'][0].json()['operations']
+        self.assertEqual(
+            sorted(o['path'] for o in operations),
+            ['/lists/bar/members/m1', '/lists/bar/members/m2']
+        )
+        self.assertEqual(json.loads(operations[0]['body']), {'interests': {'foo': True}})
+
+    def test_set_interests_sends_one_patch(self):
+        self.m.register_uri(
+            'PATCH',
+            url='{}/bar/members/m1'.format(self.lists_base_url),
+            json={'id': 'm1', 'interests': {}}
+        )
+        member = self.manager.set_interests('m1', {'Socialites': False}, verify=mailchimp.api_client.VERIFY_NONE)
+        self.assertEqual(member['id'], 'm1')
+        with self.assertRaises(mailchimp.api_client.InterestVerificationException):
+            self.manager.set_interests('m1', {'Socialites': True})
+        self.assertEqual(len([r for r in self.m.request_history if r.method == 'PATCH']), 2)
+        self.assertEqual(len([r for r in self.m.request_history if 'members' in r.url and r.method == 'GET']), 0)
+
+    def test_iter_members_by_interest_walks_every_page(self):
+        self.m.register_uri('GET', url='{}/bar/members'.format(self.lists_base_url), response_list=[
+            {'json': {'members': [{'id': 'm1'}, {'id': 'm2'}], 'total_items': 3}},
+            {'json': {'members': [{'id': 'm3'}], 'total_items': 3}},
+        ])
+        members = self.manager.iter_members_by_interest('Socialites', page_size=2, fields=['id'], prefetch=True)
+        self.assertEqual([member['id'] for member in members], ['m1', 'm2', 'm3'])
+        members_url = '{}/bar/members'.format(self.lists_base_url)
+        page_requests = [r for r in self.m.request_history if r.url.startswith(members_url)]
+        self.assertEqual([r.qs['offset'] for r in page_requests], [['0'], ['2']])
+        self.assertEqual(page_requests[0].qs['fields'], ['total_items,members.id'])
+
+    def test_not_found_results_are_cached_until_update(self):
+        email = 'nobody@example.com'
+        subscriber_hash = mailchimp.api_client.calculate_subscriber_hash(email)
+        search_url = '{}/search-members'.format(mailchimp.api_client.BASE_URL)
+        self.m.register_uri('GET', url=search_url, json={'exact_matches': {'members': []}})
+        self.m.register_uri(
+            'PATCH',
+            url='{}/bar/members/{}'.format(self.lists_base_url, subscriber_hash),
+            json={'id': 'x'}
+        )
+        mc = mailchimp.api_client.MailChimpClient('not-found-key')
+        category = settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY
+        for _ in range(2):
+            with self.assertRaises(mailchimp.api_client.NotFoundException):
+                mc.check_interest(email, 'foo', category, 'Socialites')
+        self.assertEqual(len([r for r in self.m.request_history if r.url.startswith(search_url)]), 1)
+        mc.update_member(subscriber_hash, 'bar', {'interests': {}})
+        with self.assertRaises(mailchimp.api_client.NotFoundException):
+            mc.check_interest(email, 'foo', category, 'Socialites')
+        self.assertEqual(len([r for r in self.m.request_history if r.url.startswith(search_url)]), 2)
+
+    def test_reads_request_only_projected_fields(self):
+        email = 'a+b@example.com'
+        search_url = '{}/search-members'.format(mailchimp.api_client.BASE_URL)
+        self.m.register_uri('GET', url=search_url, json={'exact_matches': {'members': [
+            {'id': 'm1', 'email_address': email, 'interests': {'foo': True}}
+        ]}})
+        category = settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY
+        self.assertTrue(self.mc.check_interest(email, 'foo', category, 'Socialites'))
+        search_request = [r for r in self.m.request_history if r.url.startswith(search_url)][0]
+        self.assertEqual(search_request.qs['query'], [email])
+        self.assertEqual(
+            search_request.qs['fields'],
+            [','.join(mailchimp.api_client.SEARCH_FIELDS).lower()]
+        )
+        lists_request = [r for r in self.m.request_history if r.path.endswith('/lists')][0]
+        self.assertEqual(lists_request.qs['fields'], ['lists.id,lists.name'])
+
+    def test_concurrent_client_returns_results_in_order(self):
+        emails = ['{}@example.com'.format(i) for i in range(20)]
+        for i, email in enumerate(emails):
+            self.m.register_uri(
+                'GET',
+                url='{}/bar/members/{}'.format(
+                    self.lists_base_url,
+                    mailchimp.api_client.calculate_subscriber_hash(email)
+                ),
+                json={'id': str(i), 'email_address': email}
+            )
+        client = mailchimp.concurrent_client.ConcurrentMailChimpClient('key', concurrency=4, use_cache=False)
+        manager = mailchimp.concurrent_client.ConcurrentMailChimpInterestManager(
+            client,
+            'foo',
+            settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY
+        )
+        results = [manager.get_member(email) for email in emails]
+        self.assertEqual([r.get()['email_address'] for r in results], emails)
+        client.close()
+
+    def test_conditional_get_serves_local_copy_on_304(self):
+        cache.invalidate_all()
+        url = '{}/lists/bar/members/m1'.format(mailchimp.api_client.BASE_URL)
+        self.m.register_uri('GET', url=url, response_list=[
+            {'json': mocks.MAILCHIMP_MOCK_RESPONSE_MEMBER, 'headers': {'ETag': '"v1"'}},
+            {'status_code': 304, 'text': ''},
+        ])
+        mc = mailchimp.api_client.MailChimpClient('etag-key')
+        self.assertEqual(mc.get_member('m1', 'bar'), mocks.MAILCHIMP_MOCK_RESPONSE_MEMBER)
+        self.assertEqual(mc.get_member('m1', 'bar', use_cache=False), mocks.MAILCHIMP_MOCK_RESPONSE_MEMBER)
+        self.assertEqual(self.m.last_request.headers['If-None-Match'], '"v1"')
+        self.assertEqual(mc.cache.stats()['not_modified'], 1)
+
+        # Uncached lookups refresh existing entries but never add new ones.
+        self.m.register_uri('GET', url='{}/lists/bar/members/m2'.format(mailchimp.api_client.BASE_URL), json={})
+        entries = mc.cache.stats()['entries']
+        mc.get_member('m2', 'bar', use_cache=False)
+        self.assertEqual(mc.cache.stats()['entries'], entries)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def test_rate_limiter_spaces_out_calls(self):
+        limiter = ratelimit.RateLimiter(50, burst=1)
+        started = time.time()
+        for _ in range(6):
+            limiter.acquire()
+        self.assertGreaterEqual(time.time() - started, 0.09)
+
+
+@requests_mock.Mocker()
+class EventbriteClientTestCase(unittest.TestCase):
+
+    def test_iter_event_attendees_streams_pages(self, m):
+        url = 'https://www.eventbriteapi.com/v3/events/e1/attendees/'
+        m.register_uri('GET', url=url, json=build_attendees_page(1, 2, 3))
+        m.register_uri('POST', url='https://www.eventbriteapi.com/v3/batch/', json=[
+            {'code': 200, 'body': json.dumps(build_attendees_page(2, 2, 3))},
+        ])
+        eb = eventbrite.api_client.EventbriteClient('token')
+        attendees = eb.iter_event_attendees('e1', status=eventbrite.api_client.ATTENDEE_STATUS_ATTENDING)
+        self.assertEqual(next(attendees)['id'], '1-0')
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual([a['id'] for a in attendees], ['1-1', '2-0'])
+        batch = json.loads(json.loads(m.last_request.body)['batch'])
+        self.assertEqual(batch, [{'method': 'GET', 'relative_url': '/events/e1/attendees/?page=2&status=attending'}])
+        with self.assertRaises(ValueError):
+            list(eb.iter_event_attendees('e1', status='refunded'))
+
+    def test_iter_pages_submits_a_window_of_batches(self, m):
+        requested = []
+
+        class RecordingClient(eventbrite.api_client.EventbriteClient):
+            def _get_pages(self, path, page_numbers, params):
+                requested.extend(page_numbers)
+                return [{'page': n} for n in page_numbers]
+
+        eb = RecordingClient('token')
+        pages = eb.iter_pages('events/e1/attendees/', range(1, 11), batch_size=1, concurrency=2)
+        self.assertEqual(next(pages), {'page': 1})
+        self.assertLessEqual(len(requested), 3)
+        self.assertEqual([p['page'] for p in pages], range(2, 11))
+
+    def test_iter_event_attendees_follows_continuation(self, m):
+        url = 'https://www.eventbriteapi.com/v3/events/e1/attendees/'
+        m.register_uri('GET', url=url, response_list=[
+            {'json': {'pagination': {'continuation': 'c1', 'has_more_items': True}, 'attendees': [{'id': '1'}]}},
+            {'json': {'pagination': {'continuation': 'c2', 'has_more_items': False}, 'attendees': [{'id': '2'}]}},
+        ])
+        eb = eventbrite.api_client.EventbriteClient('token')
+        self.assertEqual([a['id'] for a in eb.iter_event_attendees('e1')], ['1', '2'])
+        self.assertEqual(m.last_request.qs['continuation'], ['c1'])
+
+    def test_attendee_store_merges_changes_since_last_sync(self, m):
+        url = 'https://www.eventbriteapi.com/v3/events/e1/attendees/'
+        m.register_uri('GET', url=url, response_list=[
+            {'json': build_attendees_page(1, 1, 2)},
+            {'json': {
+                'pagination': {'page_count': 1, 'object_count': 1},
+                'attendees': [{'id': '1-1', 'refunded': True}]
+            }},
+        ])
+        eb = eventbrite.api_client.EventbriteClient('token')
+        store = attendee_store.EventbriteAttendeeStore()
+        self.assertEqual(store.sync(eb, 'e1'), 2)
+        self.assertNotIn('changed_since', m.last_request.qs)
+        last_synced = store.last_synced('e1')
+        self.assertEqual(store.sync(eb, 'e1'), 1)
+        self.assertEqual(m.last_request.qs['changed_since'], [last_synced.lower()])
+        self.assertEqual(store.count('e1'), 2)
+        self.assertEqual([a.refunded for a in store.iter_attendees('e1')], [False, True])
+
+    def test_attendee_store_can_be_read_while_an_event_downloads(self, m):
+        store = attendee_store.EventbriteAttendeeStore()
+        counts = []
+
+        class SlowEventbrite:
+            def iter_event_attendees(self, event_id, changed_since=None, compact=False):
+                counts.append(store.count('e2'))
+                yield eventbrite.attendee.Attendee('1', event_id=event_id)
+
+        self.assertEqual(store.sync(SlowEventbrite(), 'e1'), 1)
+        self.assertEqual(counts, [0])
+
+    def test_attendee_records_keep_only_used_fields(self, m):
+        data = {
+            'id': 'a1',
+            'event_id': 'e1',
+            'profile': {'email': 'a@example.com', 'first_name': 'A', 'last_name': 'B', 'name': 'A B', 'addresses': {}},
+            'barcodes': [{'barcode': '123'}],
+            'ticket_class_name': 'Member',
+            'refunded': False,
+            'cancelled': True,
+        }
+        record = eventbrite.attendee.Attendee.from_eventbrite(data)
+        self.assertEqual((record.email, record.name, record.ticket_class_name), ('a@example.com', 'A B', 'Member'))
+        self.assertFalse(record.is_attending())
+        self.assertEqual(eventbrite.attendee.Attendee.from_tuple(record.to_tuple()), record)
+        with self.assertRaises(AttributeError):
+            record.barcodes = []
+
+    def test_iter_pages_chunks_batches_and_retries_failed_pages(self, m):
+        url = 'https://www.eventbriteapi.com/v3/events/e1/attendees/'
+        m.register_uri('GET', url=url, json=build_attendees_page(3, 5, 10))
+
+        def batch_callback(request, context):
+            batch = json.loads(json.loads(request.body)['batch'])
+            return [
+                {'code': 500, 'body': ''} if '?page=3' in item['relative_url'] else
+                {'code': 200, 'body': json.dumps(build_attendees_page(int(item['relative_url'][-1]), 5, 10))}
+                for item in batch
+            ]
+
+        m.register_uri('POST', url='https://www.eventbriteapi.com/v3/batch/', json=batch_callback)
+        eb = eventbrite.api_client.EventbriteClient('token')
+        pages = list(eb.iter_pages('events/e1/attendees/', [2, 3, 4, 5], batch_size=2, concurrency=2))
+        self.assertEqual([p['attendees'][0]['id'] for p in pages], ['2-0', '3-0', '4-0', '5-0'])
+        self.assertEqual(len([r for r in m.request_history if r.method == 'POST']), 2)
+        self.assertEqual([r.qs['page'] for r in m.request_history if r.method == 'GET'], [['3']])
+
+    def test_event_snippets_use_expansion_and_are_cached(self, m):
+        cache.invalidate_all()
+        event = {'name': {'text': 'Party'}, 'status': 'live', 'start': {'utc': '2030-01-01T19:00:00Z'}, 'capacity': 100}
+        m.register_uri('GET', url='https://www.eventbriteapi.com/v3/users/me/owned_events/', json={
+            'pagination': {'page_count': 1, 'object_count': 3},
+            'events': [
+                dict(event, id='e1', ticket_classes=[{'quantity_sold': 3}, {'quantity_sold': '4'}]),
+                dict(event, id='e2'),
+                dict(event, id='e3', status='completed'),
+            ]
+        })
+        m.register_uri('POST', url='https://www.eventbriteapi.com/v3/batch/', json=[
+            {'code': 200, 'body': json.dumps({'ticket_classes': [{'quantity_sold': 5}]})},
+        ])
+        eb = eventbrite.api_client.EventbriteClient('snippets-token', use_cache=True)
+        for _ in range(2):
+            snippets = eb.get_event_snippets()
+            self.assertEqual([(s['id'], s['quantity_sold']) for s in snippets], [('e1', 7), ('e2', 5)])
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(m.request_history[0].qs['expand'], ['ticket_classes'])
+
+    def test_owned_events_are_paged_lazily(self, m):
+        def event(event_id, end):
+            return {'id': event_id, 'status': 'live', 'start': {'utc': end}, 'end': {'utc': end}}
+
+        first_page = {'pagination': {'page_count': 2}, 'events': [
+            event('e1', '2020-01-01T22:00:00Z'),
+            event('e2', '2020-02-01T22:00:00Z'),
+        ]}
+        second_page = {'pagination': {'page_count': 2}, 'events': [event('e3', '2020-03-01T22:00:00Z')]}
+        m.register_uri('GET', url='https://www.eventbriteapi.com/v3/users/me/owned_events/', response_list=[
+            {'json': first_page},
+            {'json': second_page},
+            {'json': first_page},
+        ])
+        eb = eventbrite.api_client.EventbriteClient('token')
+        self.assertEqual([e['id'] for e in eb.get_user_owned_events()['events']], ['e1', 'e2', 'e3'])
+        self.assertEqual([r.qs['page'] for r in m.request_history], [['1'], ['2']])
+        self.assertEqual(eb.get_next_event(current_datetime='2020-01-15T12:00:00Z')['id'], 'e2')
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(m.last_request.qs['status'], ['live'])
+        self.assertEqual(m.last_request.qs['order_by'], ['start_asc'])
+
+
+class ReconciliationTestCase(MailChimpTestCase):
+
+    def test_reconcile_joins_attendees_against_segments(self):
+        hashes = {e: mailchimp.api_client.calculate_subscriber_hash(e) for e in ['a@x.com', 'b@x.com', 'c@x.com']}
+        self.m.register_uri('GET', url='{}/bar/members'.format(self.lists_base_url), response_list=[
+            {'json': {'members': [{'id': h} for h in hashes.values()], 'total_items': 3}},
+            {'json': {'members': [{'id': hashes['a@x.com']}], 'total_items': 1}},
+            {'json': {'members': [{'id': hashes['b@x.com']}], 'total_items': 1}},
+        ])
+        segments = reconciliation.MailChimpSegments.load(self.manager, interest_names=['Members', 'Socialites'])
+        requests_made = self.m.call_count
+        attendees = [
+            eventbrite.attendee.Attendee('1', email='A@x.com', ticket_class_name='Socialite'),
+            eventbrite.attendee.Attendee('2', email='b@x.com', ticket_class_name='Socialite'),
+            eventbrite.attendee.Attendee('3', email='d@x.com', ticket_class_name='Member'),
+            eventbrite.attendee.Attendee('4', email='b@x.com', ticket_class_name='Socialite'),
+        ]
+        report = reconciliation.reconcile(attendees, segments)
+        self.assertEqual(self.m.call_count, requests_made)
+        self.assertEqual(report['totals'], {
+            'attendees': 4,
+            'socialites': 2,
+            'members': 1,
+            'duplicates': 1,
+            'not_found': 1,
+            'incorrect_ticket': 1,
+            'errors': 0,
+        })
+        self.assertEqual(report['duplicates'], ['b@x.com'])
+
+    def test_duplicates_use_canonical_emails_within_and_across_events(self):
+        segments = reconciliation.MailChimpSegments(set(), {})
+        index = reconciliation.DuplicateIndex()
+        attendee = eventbrite.attendee.Attendee
+        first = reconciliation.reconcile(
+            [attendee('1', email='Jo.Bloggs+party@x.com'), attendee('2', email=' jo.bloggs@X.com ')],
+            segments,
+            index,
+            'e1'
+        )
+        second = reconciliation.reconcile(
+            [attendee('3', email='JO.BLOGGS@x.com'), attendee('4', email='a@x.com')],
+            segments,
+            index,
+            'e2'
+        )
+        self.assertEqual(first['duplicates'], ['jo.bloggs@x.com'])
+        self.assertEqual(second['duplicates'], [])
+        self.assertEqual(index.across(), {'jo.bloggs@x.com': ['e1', 'e2']})
+        self.assertEqual(reconciliation.canonical_email('+tag@x.com'), '+tag@x.com')
+
+
+class JobQueueTestCase(unittest.TestCase):
+
+    def test_failed_jobs_are_retried_then_dead_lettered(self):
+        attempts = []
+
+        @jobs.task('test_flaky')
+        def flaky(n):
+            attempts.append(n)
+            if len(attempts) < 2:
+                raise ValueError('try again')
+
+        @jobs.task('test_broken')
+        def broken():
+            raise ValueError('broken')
+
+        queue = jobs.JobQueue(workers=2, max_attempts=3, backoff=0.01, poll_interval=0.01)
+        queue.enqueue('test_flaky', 1)
+        dead_job_id = queue.enqueue('test_broken')
+        deadline = time.time() + 5
+        while queue.stats()['queued'] + queue.stats()['running'] and time.time() < deadline:
+            time.sleep(0.01)
+        queue.stop()
+        self.assertEqual(attempts, [1, 1])
+        stats = queue.stats()
+        self.assertEqual((stats['queued'], stats['dead'], stats['succeeded'], stats['retried']), (0, 1, 1, 3))
+        self.assertEqual([j['id'] for j in queue.dead_letters()], [dead_job_id])
+        self.assertTrue(queue.requeue(dead_job_id))
+        self.assertEqual(queue.stats()['queued'], 1)
+        with self.assertRaises(jobs.UnknownTaskException):
+            queue.enqueue('test_missing')
+
+    def test_unique_jobs_are_coalesced_until_they_finish(self):
+        @jobs.task('test_unique')
+        def unique(n):
+            pass
+
+        queue = jobs.JobQueue(workers=0)
+        job_id = queue.enqueue_unique('test_unique', 'a', 1)
+        self.assertIsNone(queue.enqueue_unique('test_unique', 'a', 2))
+        self.assertIsNotNone(queue.enqueue_unique('test_unique', 'b', 3))
+        self.assertEqual(queue.run_pending(), 2)
+        self.assertNotEqual(queue.enqueue_unique('test_unique', 'a', 4), job_id)
+
+    def test_running_jobs_are_only_recovered_once_their_lease_expires(self):
+        calls = []
+        jobs.task('test_leased')(calls.append)
+        path = os.path.join(tempfile.mkdtemp(), 'jobs.sqlite')
+        first = jobs.JobQueue(path, workers=0, lease_timeout=60)
+        first.enqueue('test_leased', 1)
+        self.assertIsNotNone(first._claim())
+        second = jobs.JobQueue(path, workers=0)
+        self.assertEqual(second.run_pending(), 0)
+        self.assertEqual(second.stats()['running'], 1)
+        first._db.execute('UPDATE jobs SET lease_expires_at = 0')
+        self.assertEqual(second.run_pending(), 1)
+        self.assertEqual(calls, [1])
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        response_cache = cache.ResponseCache('test', max_entries=2)
+        for key in ['a', 'b', 'a', 'c']:
+            response_cache.get_or_fetch(key, lambda: key * 10)
+        stats = response_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 3, 1))
+        self.assertEqual(response_cache.get_or_fetch('a', lambda: 'refetched'), 'a' * 10)
+        self.assertEqual(response_cache.get_or_fetch('b', lambda: 'refetched'), 'refetched')
+
+    def test_disk_tier_and_stale_entries(self):
+        disk_path = os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+        response_cache = cache.ResponseCache('test', default_ttl=10, stale_timeout=10, disk_path=disk_path)
+        response_cache.set('a', 'old', stored_at=time.time() - 15)
+        self.assertEqual(response_cache.get_or_fetch('a', lambda: 'new'), 'old')
+        reopened = cache.ResponseCache('test', default_ttl=10, disk_path=disk_path)
+        self.assertIn(reopened.get_or_fetch('a', lambda: 'fetched'), ['old', 'new'])
+        self.assertEqual(reopened.stats()['disk_hits'], 1)
+
+    def test_sizes_are_measured_in_bytes(self):
+        response_cache = cache.ResponseCache('test')
+        response_cache.set('a', u'caf\xe9')
+        self.assertEqual(response_cache.stats()['bytes'], 5)
+        expiring = cache.ExpiringSet(ttl=0.01)
+        expiring.add('a')
+        time.sleep(0.02)
+        self.assertEqual(len(expiring), 0)
+
+
+class RequestLoggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        self.logger = logging.getLogger('test_request_logging')
+        self.logger.propagate = False
+        self.logger.handlers = []
+        handler = logging.Handler()
+        handler.emit = self.records.append
+        self.logger.addHandler(handler)
+        self.app = Flask('test_request_logging')
+
+        @self.app.route('/hook', methods=['POST'])
+        def hook():
+            return 'ok'
+
+        @self.app.route('/fail', methods=['POST'])
+        def fail():
+            return 'no', 500
+
+    def test_one_redacted_truncated_line_per_request(self):
+        self.logger.setLevel(logging.DEBUG)
+        request_logging.RequestLogger(self.logger, max_body_length=40).init_app(self.app)
+        self.app.test_client().post(
+            '/hook?token=secret',
+            data={'token': 'secret', 'text': 'x' * 100},
+            headers={'X-Request-ID': 'r1', 'Authorization': 'Bearer secret'}
+        )
+        self.assertEqual(len(self.records), 1)
+        line = self.records[0].getMessage()
+        self.assertNotIn('secret', line)
+        self.assertIn('more characters', line)
+        fields = json.loads(line.split(' ', 1)[1])
+        self.assertEqual((fields['request_id'], fields['path'], fields['status']), ('r1', '/hook', 200))
+
+    def test_unsampled_and_disabled_requests_are_not_logged(self):
+        self.logger.setLevel(logging.DEBUG)
+        request_logging.RequestLogger(self.logger, sample_rate=0).init_app(self.app)
+        client = self.app.test_client()
+        client.post('/hook')
+        self.assertEqual(self.records, [])
+        client.post('/fail')
+        self.assertEqual(len(self.records), 1)
+        self.logger.setLevel(logging.INFO)
+        client.post('/fail')
+        self.assertEqual(len(self.records), 1)
+
+
+@requests_mock.Mocker()
+class TransportTestCase(unittest.TestCase):
+
+    def test_sessions_are_shared_per_host(self, m):
+        m.register_uri('GET', url='https://example.com/a', text='a')
+        session = transport.get_session('https://example.com/a')
+        self.assertIs(transport.get_session('https://example.com/b?c=d'), session)
+        self.assertIsNot(transport.get_session('https://example.org/a'), session)
+        self.assertEqual(transport.get('https://example.com/a').text, 'a')
+        self.assertEqual(m.last_request.timeout, session.timeout)
+        with self.assertRaises(ValueError):
+            transport.configure(pool_sise=1)
+
+
+def register_mailchimp_metadata(m):
+    """ Register the list, interest category and interest lookups, returning the lists URL.
+    """
+    lists_base_url = '{}/lists'.format(mailchimp.api_client.BASE_URL)
+    m.register_uri('GET', url=lists_base_url, json=mocks.MAILCHIMP_MOCK_RESPONSE_LISTS)
+    m.register_uri(
+        'GET',
+        url='{}/bar/interest-categories'.format(lists_base_url),
+        json=mocks.MAILCHIMP_MOCK_RESPONSE_INTEREST_CATEGORIES
+    )
+    m.register_uri(
+        'GET',
+        url='{}/bar/interest-categories/foo/interests'.format(lists_base_url),
+        json=mocks.MAILCHIMP_MOCK_RESPONSE_INTERESTS
+    )
+    return lists_base_url
+
+
+def build_attendees_page(page_number, page_count, object_count):
+    """ Build one page of an Eventbrite attendee listing with at most two attendees per page.
+    """
+    size = min(2, object_count - 2 * (page_number - 1))
+    return {
+        'pagination': {'page_number': page_number, 'page_count': page_count, 'object_count': object_count},
+        'attendees': [{'id': '{}-{}'.format(page_number, i)} for i in range(size)],
+    }
+
+
+def build_batch_results_archive(items):
+    """ Build a gzipped tarball of batch operation results, as served by MailChimp.
+    """
+    content = json.dumps(items)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+        info = tarfile.TarInfo(name='b1/results.json')
+        info.size = len(content)
+        archive.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
 def build_form_payload():
     """ Build a payload for the test.
     """
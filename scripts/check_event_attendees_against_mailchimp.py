@@ -1,77 +1,112 @@
 #!/usr/bin/env python
 import logging
-from collections import Counter
 
 import click
 import simplejson as json
 
+import eventbot.integrations.defaults
 from eventbot import settings
-from eventbot.integrations import NotFoundException, mailchimp_client, eventbrite_client
+from eventbot.app import reconciliation
+from eventbot.app.eventbrite import api_client as eventbrite_client
+from eventbot.app.eventbrite import attendee_store
+from eventbot.app.eventbrite.attendee import Attendee
+from eventbot.app.mailchimp import api_client as mailchimp_client
+from eventbot.app.mailchimp import concurrent_client as mailchimp_concurrent_client
+from eventbot.app.mailchimp.api_client import NotFoundException
 
 log = logging.getLogger(__name__)
 
 
-def check_attendees(attendees):
-    results = {
-        'attendees': [],
-        'totals': {}
-    }
-    for a in attendees:
-        results['attendees'].append(check_attendee(a))
-    results['duplicates'] = check_duplicates([a['profile']['email'] for a in attendees])
-    log.debug("duplicates ({}): {}".format(len(results['duplicates']), results['duplicates']))
-    results['totals'] = {
-        'attendees': len(results['attendees']),
-        'socialites': len([a for a in results['attendees'] if a['is_socialite'] is True]),
-        'members': len([a for a in results['attendees'] if a['is_member'] is True]),
-        'duplicates': len(results['duplicates']),
-        'not_found': len([a for a in results['attendees'] if a['found'] is False]),
-        'incorrect_ticket': len([a for a in results['attendees'] if a['has_correct_ticket'] is False]),
-    }
-    return results
-
-
-def check_attendee(a):
-    """ Check one Eventbrite attendee against MailChimp.
+def check_attendees(
+        attendees,
+        bulk=True,
+        workers=eventbot.integrations.defaults.MAILCHIMP_MAX_CONNECTIONS,
+        rate_limit=eventbot.integrations.defaults.MAILCHIMP_CHECKS_PER_SECOND,
+        progress=None
+):
+    """ Check attendees against MailChimp.
+
+    :param attendees: iterable of Attendee records; it is only iterated once, so a generator will do
+    :param bulk: whether to load the MailChimp segments once and join them locally, rather than
+        looking up each attendee
+    :param workers: number of attendees to look up at once, when not in bulk mode
+    :param rate_limit: maximum number of attendee lookups to start per second, when not in bulk mode
+    :param progress: function called with the number of attendees checked since the previous call
     """
-    o = {
-        'email': a['profile']['email'],
-        'found': False,
-        'is_socialite': False,
-        'is_member': False,
-        'has_correct_ticket': True
-    }
-    mc = mailchimp_client.MailChimpClient(settings.MAILCHIMP_APIKEY)
+    if bulk:
+        report = reconciliation.reconcile_with_mailchimp(attendees)
+        if progress is not None:
+            progress(report['totals']['attendees'])
+    else:
+        report = check_attendees_concurrently(attendees, workers, rate_limit, progress)
+    log.debug("duplicates ({}): {}".format(len(report['duplicates']), report['duplicates']))
+    return report
+
+
+def check_attendees_concurrently(attendees, workers, rate_limit, progress=None):
+    """ Look up each attendee in MailChimp on a pool of worker threads.
+
+    Results are reported in attendee order. An attendee whose lookup fails is listed under
+    'errors' instead of stopping the run.
+    """
+    index = reconciliation.DuplicateIndex()
+    client = mailchimp_concurrent_client.ConcurrentMailChimpClient(
+        settings.MAILCHIMP_APIKEY,
+        concurrency=workers,
+        rate_limit=rate_limit
+    )
+    results = []
+    errors = []
     try:
-        o['is_member'] = mc.check_interest(
-            a['profile']['email'],
+        pending = []
+        for a in attendees:
+            index.add(None, a.email)
+            pending.append((a, client.submit(check_attendee, a, client.mc)))
+        for a, result in pending:
+            try:
+                results.append(result.get())
+            except Exception as e:
+                log.warn("Could not check {} ({})".format(a.email, e))
+                errors.append({'email': a.email, 'error': str(e)})
+            if progress is not None:
+                progress(1)
+    finally:
+        client.close()
+    return reconciliation.build_report(results, index.within(None), errors)
+
+
+def check_attendee(a, mc=None):
+    """ Check one Eventbrite attendee, given as an Attendee record, against MailChimp.
+    """
+    if mc is None:
+        mc = mailchimp_client.MailChimpClient(settings.MAILCHIMP_APIKEY)
+    found = False
+    is_member = False
+    is_socialite = False
+    try:
+        is_member = mc.check_interest(
+            a.email,
             settings.MAILCHIMP_DEFAULT_LIST,
             settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY,
-            'Members'
+            settings.MAILCHIMP_INTEREST_NAME_MEMBER
         )
-        o['is_socialite'] = mc.check_interest(
-            a['profile']['email'],
+        is_socialite = mc.check_interest(
+            a.email,
             settings.MAILCHIMP_DEFAULT_LIST,
             settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY,
-            'Socialites'
+            settings.MAILCHIMP_INTEREST_NAME_SOCIALITE
         )
-        o['found'] = True
+        found = True
     except NotFoundException as e:
         log.debug(e.message)
-    if o['found'] is True:
-        if o['is_member'] and o['is_socialite']:
-            log.warn("Attendee {} is marked as a member and a socialite!".format(a['profile']['email']))
-        if o['is_member'] and a['ticket_class_name'].lower() == 'socialite'\
-                or o['is_socialite'] and a['ticket_class_name'].lower() == 'member':
-            o['has_correct_ticket'] = False
     log.debug("Checked {} {} (email={}): Member={} Socialite={}".format(
-        a['profile']['first_name'],
-        a['profile']['last_name'],
-        a['profile']['email'],
-        o['is_member'],
-        o['is_socialite']
+        a.first_name,
+        a.last_name,
+        a.email,
+        is_member,
+        is_socialite
     ))
-    return o
+    return reconciliation.build_result(a, found, is_member, is_socialite)
 
 
 @click.group()
@@ -81,65 +116,128 @@ def cli(debug):
     pass
 
 
+def check_options(f):
+    """ Add the options shared by the check commands.
+    """
+    f = click.option(
+        '--bulk/--no-bulk',
+        default=True,
+        help='load MailChimp interest segments once instead of one lookup per attendee'
+    )(f)
+    f = click.option(
+        '--workers',
+        default=eventbot.integrations.defaults.MAILCHIMP_MAX_CONNECTIONS,
+        help='number of attendees to look up at once with --no-bulk'
+    )(f)
+    f = click.option(
+        '--rate',
+        default=eventbot.integrations.defaults.MAILCHIMP_CHECKS_PER_SECOND,
+        type=float,
+        help='maximum number of attendee lookups to start per second with --no-bulk'
+    )(f)
+    return f
+
+
 @click.command()
 @click.option('--eid', default='123', help='Eventbrite event ID')
-def check(eid):
+@click.option('--full/--no-full', default=False, help='download every attendee rather than only changes')
+@check_options
+def check(eid, full, bulk, workers, rate):
     """ Download and check attendee data.
     """
     click.echo("Downloading from Eventbrite...")
     eb = eventbrite_client.EventbriteClient(settings.EVENTBRITE_OAUTH_TOKEN)
-    attendees = eb.get_event_attendees(event_id=eid)
+    store = attendee_store.get_store()
+    store.sync(eb, eid, full=full)
     click.echo("Checking attendees against MailChimp...")
-    report = check_attendees(attendees)
+    with click.progressbar(length=store.count(eid), label='Checking') as bar:
+        report = check_attendees(store.iter_attendees(eid), bulk, workers, rate, progress=bar.update)
+    echo_report(report)
+
+
+@click.command()
+@click.option('--input_filename', default='attendees.json', help='filename containing JSON attendee data')
+@check_options
+def check_file(input_filename, bulk, workers, rate):
+    """ Check attendee data from a file.
+    """
+    with open(input_filename, 'r') as f:
+        attendees = json.load(f)
+    with click.progressbar(length=len(attendees), label='Checking') as bar:
+        report = check_attendees(
+            (Attendee.from_eventbrite(a) for a in attendees),
+            bulk,
+            workers,
+            rate,
+            progress=bar.update
+        )
+    echo_report(report)
+
+
+@click.command()
+@click.option('--full/--no-full', default=False, help='download every attendee rather than only changes')
+def check_live(full):
+    """ Check the attendees of every live event, sharing one load of the MailChimp segments.
+    """
+    click.echo("Loading MailChimp segments...")
+    segments = reconciliation.load_default_segments()
+    eb = eventbrite_client.EventbriteClient(settings.EVENTBRITE_OAUTH_TOKEN)
+    o = reconciliation.reconcile_events(eb, segments, full=full)
+    for event_id, report in o['events'].items():
+        click.echo("\n{} ({})".format(report['name'], event_id))
+        echo_report(report)
+    click.echo("\nDuplicates across events:\n\t{}".format('\n\t'.join(
+        ['{} ({})'.format(email, ', '.join(event_ids)) for email, event_ids in sorted(o['duplicates'].items())]
+    )))
+
+
+def echo_report(report):
     click.echo("Report: {} attendees:"
                "\n\t{} socialites"
                "\n\t{} members"
                "\n\t{} duplicate(s)"
                "\n\t{} not found in database"
-               "\n\t{} with the wrong ticket".format(
+               "\n\t{} with the wrong ticket"
+               "\n\t{} could not be checked".format(
                     report['totals']['attendees'],
                     report['totals']['socialites'],
                     report['totals']['members'],
                     report['totals']['duplicates'],
                     report['totals']['not_found'],
-                    report['totals']['incorrect_ticket']
+                    report['totals']['incorrect_ticket'],
+                    report['totals']['errors']
                     )
                )
     click.echo("Duplicates:\n\t{}".format('\n\t'.join(report['duplicates'])))
     click.echo("Not found:\n\t{}".format('\n\t'.join([a['email'] for a in report['attendees'] if a['found'] is False])))
+    if report['errors']:
+        click.echo("Errors:\n\t{}".format('\n\t'.join(
+            ['{} ({})'.format(e['email'], e['error']) for e in report['errors']]
+        )))
 
 
 @click.command()
-@click.option('--input_filename', default='attendees.json', help='filename containing JSON attendee data')
-@click.option('--download', default=False, help='whether to also download')
-def check_file(input_filename):
-    """ Check attendee data from a file.
-    """
-    with open(input_filename, 'r') as f:
-        attendees = json.load(f)
-    check_attendees(attendees)
-
-
-def check_duplicates(emails):
-    return [k for k, v in Counter(emails).items() if v > 1]
-
-
-@click.command()
-@click.option('--save', default=False, help='save to file')
 @click.option('--output_filename', default='attendees.json', help='output filename to write the JSON attendee data')
 @click.argument('eid')
 def download(eid, output_filename):
     eb = eventbrite_client.EventbriteClient(settings.EVENTBRITE_OAUTH_TOKEN)
-    attendees = eb.get_event_attendees(event_id=eid)
+    count = 0
     with open(output_filename, 'w') as f:
-        json.dump(attendees, f, indent=2)
-    log.info('Attendee data ({} records) written to {}'.format(len(attendees), output_filename))
-    return attendees
+        # Write a JSON array one attendee at a time rather than building the whole list first.
+        f.write('[')
+        for attendee in eb.iter_event_attendees(event_id=eid):
+            f.write(',\n' if count else '\n')
+            f.write(json.dumps(attendee, indent=2))
+            count += 1
+        f.write('\n]\n')
+    log.info('Attendee data ({} records) written to {}'.format(count, output_filename))
+    return count
 
 
 cli.add_command(check)
 cli.add_command(download)
 cli.add_command(check_file)
+cli.add_command(check_live)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
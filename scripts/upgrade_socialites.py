@@ -7,11 +7,19 @@ import sys
 
 from eventbot import settings
 from eventbot.app.mailchimp import api_client as mailchimp_client
+from eventbot.app.mailchimp import concurrent_client as mailchimp_concurrent_client
+from eventbot.app.mailchimp import mirror as mailchimp_mirror
 
 log = logging.getLogger(__name__)
 
 pp = pprint.PrettyPrinter(indent=4)
 
+UPGRADE_INTERESTS = {
+    settings.MAILCHIMP_INTEREST_NAME_SOCIALITE: False,
+    settings.MAILCHIMP_INTEREST_NAME_MEMBER: True,
+    settings.MAILCHIMP_INTEREST_NAME_UPGRADED: True,
+}
+
 
 @click.group()
 @click.option('--debug/--no-debug', default=False)
@@ -31,12 +39,12 @@ def clear_upgraded_segment():
         settings.MAILCHIMP_DEFAULT_LIST,
         settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY
     )
-    members = mc.lookup_members_by_interest(interest_name)
-    log.info("{} member(s) found in {} segment".format(len(members['members']), interest_name))
-    member_email_addresses = [m['email_address'] for m in members['members']]
-    pp.pprint(member_email_addresses)
-    for m in members['members']:
-        mc.remove_interest(m['id'], interest_name)
+    members = mc.iter_members_by_interest(interest_name, fields=['id', 'email_address'], prefetch=True)
+    member_email_addresses = {m['id']: m['email_address'] for m in members}
+    log.info("{} member(s) found in {} segment".format(len(member_email_addresses), interest_name))
+    pp.pprint(member_email_addresses.values())
+    results = mc.bulk_update_interests({member_id: {interest_name: False} for member_id in member_email_addresses})
+    report_bulk_results(results, member_email_addresses)
 
 
 @click.command()
@@ -51,13 +59,11 @@ def upgrade(email_address):
         settings.MAILCHIMP_DEFAULT_INTEREST_CATEGORY
     )
     try:
-        member = mc.get_member(email_address)
+        member = mc.get_member(email_address, fields=['id'])
     except requests.exceptions.HTTPError as e:
         click.echo("Error: could not find {} in database (message='{}')".format(email_address, e.message))
         sys.exit(1)
-    mc.remove_interest(member['id'], settings.MAILCHIMP_INTEREST_NAME_SOCIALITE)
-    mc.add_interest(member['id'], settings.MAILCHIMP_INTEREST_NAME_MEMBER)
-    mc.add_interest(member['id'], settings.MAILCHIMP_INTEREST_NAME_UPGRADED)
+    mc.set_interests(member['id'], UPGRADE_INTERESTS)
 
 
 @click.command()
@@ -72,23 +78,23 @@ def upgrade_file(filename):
     )
     with open(filename) as f:
         email_address_list = f.readlines()
-    email_address_list = map(str.strip, email_address_list)
-    for email_address in email_address_list:
-        try:
-            member = mc.get_member(email_address)
-        except requests.exceptions.HTTPError as e:
-            click.echo("Error: could not find {} in database (message='{}')".format(email_address, e.message))
-            sys.exit(1)
-        mc.remove_interest(member['id'], settings.MAILCHIMP_INTEREST_NAME_SOCIALITE)
-        mc.add_interest(member['id'], settings.MAILCHIMP_INTEREST_NAME_MEMBER)
-        mc.add_interest(member['id'], settings.MAILCHIMP_INTEREST_NAME_UPGRADED)
-        click.echo('Upgraded {}'.format(email_address))
+    email_address_list = [e for e in map(str.strip, email_address_list) if e]
+    member_email_addresses = {mailchimp_client.calculate_subscriber_hash(e): e for e in email_address_list}
+    click.echo("Upgrading {} address(es) from socialite to member...".format(len(member_email_addresses)))
+    results = mc.bulk_update_interests({member_id: UPGRADE_INTERESTS for member_id in member_email_addresses})
+    if not report_bulk_results(results, member_email_addresses, success_message='Upgraded'):
+        sys.exit(1)
 
 
 @click.command()
+@click.option(
+    '--mirror/--no-mirror',
+    default=True,
+    help='sync the whole list locally instead of one lookup per address'
+)
 @click.argument('filename')
-def find_list_members(filename):
-    """ Upgrade a list of users from a file from socialite to member.
+def find_list_members(filename, mirror):
+    """ Check whether each address in a file is in the list.
     """
     mc = mailchimp_client.MailChimpInterestManager(
         mailchimp_client.MailChimpClient(settings.MAILCHIMP_APIKEY),
@@ -98,12 +104,52 @@ def find_list_members(filename):
     with open(filename) as f:
         email_address_list = f.readlines()
     email_address_list = map(str.strip, email_address_list)
-    for email_address in email_address_list:
+    if mirror:
+        list_mirror = mailchimp_mirror.MailChimpMemberMirror(mc.mc, mc.list_id)
+        click.echo("Syncing {} members...".format(settings.MAILCHIMP_DEFAULT_LIST))
+        list_mirror.sync()
+        for email_address in email_address_list:
+            if email_address in list_mirror:
+                click.echo("Found {} in database".format(email_address))
+            else:
+                click.echo("Error: could not find {} in database".format(email_address))
+        return
+    client = mailchimp_concurrent_client.ConcurrentMailChimpClient(settings.MAILCHIMP_APIKEY)
+    results = [
+        (email_address, client.get_member(
+            mailchimp_client.calculate_subscriber_hash(email_address),
+            mc.list_id,
+            fields=['id']
+        ))
+        for email_address in email_address_list
+    ]
+    for email_address, result in results:
         try:
-            mc.get_member(email_address.strip())
-            click.echo("Found {} in database (message='{}')".format(email_address, e.message))
+            result.get()
+            click.echo("Found {} in database".format(email_address))
         except requests.exceptions.HTTPError as e:
             click.echo("Error: could not find {} in database (message='{}')".format(email_address, e.message))
+    client.close()
+
+
+def report_bulk_results(results, member_email_addresses, success_message='Updated'):
+    """ Echo the outcome of a bulk update per email address, returning whether all succeeded.
+    """
+    failures = 0
+    for member_id, result in sorted(results.items(), key=lambda r: member_email_addresses[r[0]]):
+        email_address = member_email_addresses[member_id]
+        if result['ok']:
+            click.echo('{} {}'.format(success_message, email_address))
+        else:
+            failures += 1
+            click.echo("Error: could not update {} (status={}, message='{}')".format(
+                email_address,
+                result['status_code'],
+                result['response'].get('detail', '')
+            ))
+    click.echo("{} succeeded, {} failed".format(len(results) - failures, failures))
+    return failures == 0
+
 
 cli.add_command(clear_upgraded_segment)
 cli.add_command(find_list_members)
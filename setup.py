@@ -9,6 +9,7 @@ setup(
         'eventbot.app.eventbrite',
         'eventbot.app.mailchimp',
         'eventbot.app.slack',
+        'eventbot.integrations',
     ],
     license='Creative Commons Attribution-Noncommercial-Share Alike license',
     long_description=open('README.md').read(),